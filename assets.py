@@ -0,0 +1,98 @@
+import gzip
+import hashlib
+from pathlib import Path
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None # Optional: without it only gzip variants are served
+
+# Bodies are compressed once when loaded, so the slowest/strongest settings are fine
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+# Pages change with deploys: browsers always revalidate, the ETag turns that into a 304
+CACHE_CONTROL = "no-cache"
+
+def etag_matches(request, etag):
+    header = request.headers.get('If-None-Match', '')
+    return header.strip() == '*' or etag in [tag.strip() for tag in header.split(',')]
+
+def accepted_encodings(request):
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    pass
+        if name and q > 0:
+            accepted.add(name)
+    return accepted
+
+class CompressedBody:
+    # One body with its precompressed variants and a strong ETag per variant
+    def __init__(self, body, content_type='text/html'):
+        self.content_type = content_type
+        self.variants = {'identity': body, 'gzip': gzip.compress(body, GZIP_LEVEL, mtime=0)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+        # Tiny bodies may not shrink
+        self.variants = {
+            encoding: data for encoding, data in self.variants.items()
+            if encoding == 'identity' or len(data) < len(body)
+        }
+        digest = hashlib.sha1(body).hexdigest()[:20]
+        # Different bytes, different strong ETag
+        self.etags = {
+            encoding: f'"{digest}"' if encoding == 'identity' else f'"{digest}-{encoding}"'
+            for encoding in self.variants
+        }
+
+    def pick_encoding(self, request):
+        accepted = accepted_encodings(request)
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                return encoding
+        return 'identity'
+
+    def response(self, request, cache_control=CACHE_CONTROL):
+        encoding = self.pick_encoding(request)
+        etag = self.etags[encoding]
+        headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+        if etag_matches(request, etag):
+            return web.Response(status=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return web.Response(
+            body=self.variants[encoding], content_type=self.content_type, charset='utf-8', headers=headers
+        )
+
+class StaticFile:
+    # Read, hashed and compressed once; with reload=True (dev) re-read when the mtime changes
+    def __init__(self, path, content_type='text/html', reload=False):
+        self.path = Path(path)
+        self.content_type = content_type
+        self.reload = reload
+        self.mtime = None
+        self.body = None
+        self.load()
+
+    def load(self):
+        mtime = self.path.stat().st_mtime_ns
+        self.body = CompressedBody(self.path.read_bytes(), self.content_type)
+        self.mtime = mtime
+
+    def get(self):
+        if self.reload and self.path.stat().st_mtime_ns != self.mtime:
+            self.load()
+        return self.body
+
+    def response(self, request):
+        return self.get().response(request)
@@ -0,0 +1,182 @@
+# Shared pieces of the benchmark harnesses: a temporary database, seeding through
+# database.py, a local fake Telegram Bot API and latency statistics.
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import date, timedelta
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+
+# Run as `python -m benchmarks.<name>` from the repo root
+import database as db
+
+BENCH_TOKEN = "123456:benchmark"
+FIRST_ROOM = 1000
+
+def use_temp_database():
+    # Point database.py at a fresh file; the directory lives until the process exits
+    directory = tempfile.TemporaryDirectory(prefix="bench-")
+    db.DB_NAME = os.path.join(directory.name, "bench.db")
+    return directory
+
+# --- Fake Telegram Bot API ---
+class FakeTelegram:
+    # Answers every Bot API method with ok; latency simulates the round trip to Telegram
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.server = None
+        self._message_id = 0
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = await request.post() if request.can_read_body else {}
+        if method.lower() == 'sendmessage':
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(data.get('chat_id', 0)), "type": "private"},
+                "text": data.get('text', '')
+            }
+        elif method.lower() == 'getme':
+            result = {"id": 123456, "is_bot": True, "first_name": "Benchmark"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+    async def close(self):
+        await self.server.close()
+
+    def make_bot(self):
+        base = str(self.server.make_url('')).rstrip('/')
+        session = AiohttpSession(api=TelegramAPIServer.from_base(base))
+        return Bot(token=BENCH_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+# --- Seeding ---
+async def seed(rng, rooms=50, bookings=5000, orders=5000, menu=30):
+    # Back-to-back stays per room, centred on today so some are active now.
+    # Returns what the scenarios need to build realistic requests.
+    room_numbers = [FIRST_ROOM + i for i in range(rooms)]
+    for number in room_numbers:
+        await db.add_room(number, rng.choice(["Standard", "Luxe"]), rng.choice([3000, 4000, 5000]), "")
+
+    menu_items = []
+    for i in range(menu):
+        category = rng.choice(["food", "drinks", "service"])
+        price = rng.randrange(100, 1500, 50)
+        item_id = await db.add_menu_item(f"Позиция {i}", price, "", category)
+        menu_items.append({"id": item_id, "name": f"Позиция {i}", "price": price})
+
+    per_room = max(1, bookings // max(rooms, 1))
+    start = date.today() - timedelta(days=per_room * 2)
+    cursors = {number: start for number in room_numbers}
+    rows = []
+    booking_rows = []
+    for i in range(bookings):
+        number = room_numbers[i % rooms]
+        check_in = cursors[number]
+        check_out = check_in + timedelta(days=rng.randint(1, 7))
+        cursors[number] = check_out
+        phone = f"+7900{i:07d}"
+        row = (number, f"Гость {i}", check_in.isoformat(), check_out.isoformat(),
+               3000, phone, 0, 0, 'booked', 0)
+        rows.append(row)
+    for offset in range(0, len(rows), 1000):
+        chunk = rows[offset:offset + 1000]
+        # Generated stays never overlap
+        first_id, _ = await db.import_bookings_batch(chunk, allow_overlap=True)
+        await db.finish_bookings_import(first_id)
+        for booking_id, row in enumerate(chunk, start=first_id):
+            booking_rows.append({"id": booking_id, **dict(zip(db.IMPORT_BOOKING_COLUMNS, row))})
+
+    async def place(i):
+        items = {}
+        for item in rng.sample(menu_items, k=min(len(menu_items), rng.randint(1, 3))):
+            items[str(item['id'])] = {"name": item['name'], "qty": rng.randint(1, 3), "price": item['price']}
+        total = sum(v['qty'] * v['price'] for v in items.values())
+        await db.place_order(10_000 + i, items, total, rng.choice(room_numbers))
+
+    # Concurrent so the writer can group-commit the seeding
+    for offset in range(0, orders, 500):
+        await asyncio.gather(*(place(i) for i in range(offset, min(orders, offset + 500))))
+
+    return {
+        "rooms": room_numbers,
+        "menu": menu_items,
+        "bookings": booking_rows,
+        "future_start": max(cursors.values()) if cursors else date.today()
+    }
+
+# --- Statistics ---
+def percentile(sorted_values, p):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+def summarize(latencies, elapsed):
+    values = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "count": len(values),
+        "throughput_rps": round(len(values) / elapsed, 2) if elapsed else None,
+        "mean_ms": ms(sum(values) / len(values)) if values else None,
+        "p50_ms": ms(percentile(values, 50)),
+        "p95_ms": ms(percentile(values, 95)),
+        "p99_ms": ms(percentile(values, 99)),
+        "max_ms": ms(values[-1]) if values else None
+    }
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count()
+    }
+
+def compare(result, baseline_path, tolerance):
+    # Names every scenario whose p95 got worse than baseline * (1 + tolerance)
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, stats in result['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if not old or old.get('p95_ms') is None or stats.get('p95_ms') is None:
+            continue
+        if stats['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+            regressions.append({"scenario": name, "baseline_p95_ms": old['p95_ms'], "p95_ms": stats['p95_ms']})
+    return regressions
+
+def write_result(result, output):
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+def make_rng(seed):
+    return random.Random(seed)
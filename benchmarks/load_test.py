@@ -0,0 +1,237 @@
+# HTTP API and bot load test against a temporary, seeded database.
+#
+#   python -m benchmarks.load_test --bookings 20000 --concurrency 32 --duration 20 --output run.json
+#   python -m benchmarks.load_test --baseline run.json   # exits 1 if any p95 regressed
+#
+# The app is bot.create_app() served on a local port; bot traffic goes through
+# dp.feed_update() and its replies to a local fake Bot API. Clients share the event
+# loop with the server, so compare runs made on the same machine with the same flags.
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from datetime import date, timedelta
+
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+from aiogram.types import Update
+
+from benchmarks.common import (
+    FakeTelegram, compare, environment, make_rng, seed, summarize, use_temp_database, write_result
+)
+
+import bot as bot_module
+
+DEFAULT_MIX = "admin_poll=40,guest_menu=30,booking_update=10,booking_create=5,order=15"
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+class Client:
+    # One simulated user: its own RNG and the admin page's last ETag
+    def __init__(self, index, run):
+        self.run = run
+        self.rng = make_rng(run.args.seed * 1000 + index)
+        self.index = index
+        self.etag = None
+
+async def admin_poll(client):
+    run = client.run
+    day = date.today() + timedelta(days=client.rng.randint(-7, 7))
+    params = {"from": day.isoformat(), "to": (day + timedelta(days=14)).isoformat()}
+    headers = {"If-None-Match": client.etag} if client.etag else {}
+    async with run.http.get(run.url('/api/bookings'), params=params, headers=headers) as response:
+        await response.read()
+        client.etag = response.headers.get('ETag')
+        return response.status
+
+async def guest_menu(client):
+    async with client.run.http.get(client.run.url('/api/menu')) as response:
+        await response.read()
+        return response.status
+
+async def booking_update(client):
+    booking = client.rng.choice(client.run.data['bookings'])
+    payload = {
+        "id": booking['id'],
+        "room_number": booking['room_number'],
+        "guest_name": booking['guest_name'],
+        "check_in": booking['check_in'],
+        "check_out": booking['check_out'],
+        "cost_per_night": booking['cost_per_night'],
+        "phone": booking['phone'],
+        "paid_amount": client.rng.randrange(0, 20000, 500)
+    }
+    async with client.run.http.put(client.run.url('/api/bookings'), json=payload) as response:
+        await response.read()
+        return response.status
+
+async def booking_create(client):
+    # Mostly free dates past the seeded range; some collide and get 409
+    run = client.run
+    check_in = run.data['future_start'] + timedelta(days=client.rng.randint(0, 365))
+    payload = {
+        "room_number": client.rng.choice(run.data['rooms']),
+        "guest_name": f"Нагрузка {client.index}",
+        "check_in": check_in.isoformat(),
+        "check_out": (check_in + timedelta(days=client.rng.randint(1, 5))).isoformat(),
+        "cost_per_night": 3000
+    }
+    async with run.http.post(run.url('/api/bookings'), json=payload) as response:
+        await response.read()
+        return response.status
+
+async def order(client):
+    run = client.run
+    items = {}
+    for item in client.rng.sample(run.data['menu'], k=min(len(run.data['menu']), client.rng.randint(1, 3))):
+        items[str(item['id'])] = {"name": item['name'], "qty": client.rng.randint(1, 2), "price": item['price']}
+    run.update_id += 1
+    user_id = 500_000 + client.index
+    update = Update.model_validate({
+        "update_id": run.update_id,
+        "message": {
+            "message_id": run.update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Guest", "username": f"guest{client.index}"},
+            "web_app_data": {
+                "button_text": "Меню",
+                "data": json.dumps({
+                    "type": "order",
+                    "room": str(client.rng.choice(run.data['rooms'])),
+                    "items": items,
+                    "total_price": sum(v['qty'] * v['price'] for v in items.values())
+                })
+            }
+        }
+    })
+    await bot_module.dp.feed_update(run.bot, update)
+    return 200
+
+SCENARIOS = {
+    "admin_poll": admin_poll,
+    "guest_menu": guest_menu,
+    "booking_update": booking_update,
+    "booking_create": booking_create,
+    "order": order,
+}
+
+class Run:
+    def __init__(self, args):
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.server = None
+        self.http = None
+        self.bot = None
+        self.data = None
+        self.update_id = 0
+        self.latencies = {name: [] for name in self.mix}
+        self.statuses = {name: {} for name in self.mix}
+        self.errors = {name: 0 for name in self.mix}
+
+    def url(self, path):
+        return str(self.server.make_url(path))
+
+    async def worker(self, index, deadline, record):
+        client = Client(index, self)
+        names = list(self.mix)
+        weights = list(self.mix.values())
+        while time.monotonic() < deadline:
+            name = client.rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = await SCENARIOS[name](client)
+            except Exception as e:
+                logging.debug(f"{name} failed: {e}")
+                status = 'error'
+                if record:
+                    self.errors[name] += 1
+            elapsed = time.perf_counter() - start
+            if record:
+                self.latencies[name].append(elapsed)
+                self.statuses[name][str(status)] = self.statuses[name].get(str(status), 0) + 1
+
+    async def phase(self, seconds, record):
+        deadline = time.monotonic() + seconds
+        started = time.perf_counter()
+        await asyncio.gather(*(self.worker(i, deadline, record) for i in range(self.args.concurrency)))
+        return time.perf_counter() - started
+
+async def main(args):
+    logging.basicConfig(level=logging.WARNING)
+    temp_dir = use_temp_database()
+    telegram = FakeTelegram(args.telegram_latency / 1000)
+    await telegram.start()
+    run = Run(args)
+    run.bot = telegram.make_bot()
+    run.server = TestServer(bot_module.create_app(run.bot, receive_updates=False))
+    await run.server.start_server()
+    try:
+        seed_started = time.perf_counter()
+        run.data = await seed(
+            make_rng(args.seed), rooms=args.rooms, bookings=args.bookings, orders=args.orders, menu=args.menu
+        )
+        seed_seconds = time.perf_counter() - seed_started
+
+        async with ClientSession() as http:
+            run.http = http
+            if args.warmup:
+                await run.phase(args.warmup, record=False)
+            elapsed = await run.phase(args.duration, record=True)
+    finally:
+        await run.server.close()
+        await run.bot.session.close()
+        await telegram.close()
+        temp_dir.cleanup()
+
+    scenarios = {}
+    for name in run.mix:
+        scenarios[name] = {
+            **summarize(run.latencies[name], elapsed),
+            "statuses": run.statuses[name],
+            "errors": run.errors[name]
+        }
+    everything = [value for values in run.latencies.values() for value in values]
+    result = {
+        "benchmark": "load_test",
+        "config": {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        "environment": environment(),
+        "seed_seconds": round(seed_seconds, 3),
+        "duration_seconds": round(elapsed, 3),
+        "total": {**summarize(everything, elapsed), "errors": sum(run.errors.values())},
+        "scenarios": scenarios,
+        "telegram_calls": telegram.calls
+    }
+    if args.baseline:
+        result['regressions'] = compare(result, args.baseline, args.tolerance)
+    write_result(result, args.output)
+    return 1 if result.get('regressions') else 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for the HTTP API and bot paths")
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--bookings', type=int, default=5000)
+    parser.add_argument('--orders', type=int, default=5000)
+    parser.add_argument('--menu', type=int, default=30)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=2, help="unmeasured seconds before the run")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="scenario=weight,... of " + ", ".join(SCENARIOS))
+    parser.add_argument('--telegram-latency', type=float, default=0, help="fake Bot API delay, ms")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    parser.add_argument('--baseline', help="earlier JSON result to compare p95 against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 growth over baseline")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,257 @@
+# Replays Telegram updates through bot.dp to measure dispatcher throughput.
+#
+#   python -m benchmarks.replay updates.jsonl --concurrency 64 --output replay.json
+#   python -m benchmarks.replay --synthetic 3000 --save updates.jsonl   # check-in day mix
+#
+# Input is one Update JSON object per line, as the Bot API returns them. Updates
+# of one chat are processed in file order, different chats concurrently. Outgoing
+# Bot API calls go to an in-process session that only records them.
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+import aiosqlite
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.methods import SendMessage
+from aiogram.types import Chat, Message, Update
+
+from benchmarks.common import (
+    BENCH_TOKEN, environment, make_rng, seed, summarize, use_temp_database, write_result
+)
+
+import bot as bot_module
+import database as db
+
+# --- Fake Bot session ---
+class RecordingSession(BaseSession):
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = {}
+        self._message_id = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, SendMessage):
+            self._message_id += 1
+            return Message(
+                message_id=self._message_id,
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        # Abstract in BaseSession; a download is recorded and comes back empty
+        self.calls['stream_content'] = self.calls.get('stream_content', 0) + 1
+        yield b""
+
+    async def close(self):
+        pass
+
+# --- Per-handler measurements ---
+# Statements are counted where database.py issues them (aiosqlite.Connection in the
+# handler's own task), so every query lands on the handler that caused it.
+_queries = ContextVar('replay_queries', default=None)
+
+def count_queries():
+    for name in ('execute', 'executemany', 'executescript', 'execute_fetchall', 'execute_insert'):
+        original = getattr(aiosqlite.Connection, name)
+
+        def counted(self, *args, _original=original, **kwargs):
+            counter = _queries.get()
+            if counter is not None:
+                counter[0] += 1
+            return _original(self, *args, **kwargs)
+
+        setattr(aiosqlite.Connection, name, counted)
+
+class HandlerStats(BaseMiddleware):
+    def __init__(self):
+        self.latencies = {}
+        self.queries = {}
+        self.errors = {}
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        counter = [0]
+        token = _queries.set(counter)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            raise
+        finally:
+            self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+            self.queries.setdefault(name, []).append(counter[0])
+            _queries.reset(token)
+
+# --- Synthetic updates ---
+def synthetic_updates(rng, guests, data):
+    # A check-in day: each guest starts the bot from the room QR code, registers the
+    # phone of their booking, orders a few times and sometimes leaves a review.
+    # Guests interleave randomly; each guest's own updates keep their order.
+    stories = []
+    for i in range(guests):
+        user_id = 700_000 + i
+        booking = data['bookings'][i % len(data['bookings'])]
+        user = {"id": user_id, "is_bot": False, "first_name": f"Гость {i}", "username": f"guest{i}"}
+        messages = [
+            {"text": f"/start room_{booking['room_number']}"},
+            {"text": booking['phone']},
+        ]
+        for _ in range(rng.randint(0, 3)):
+            items = {}
+            for item in rng.sample(data['menu'], k=min(len(data['menu']), rng.randint(1, 3))):
+                items[str(item['id'])] = {"name": item['name'], "qty": rng.randint(1, 2), "price": item['price']}
+            payload = {
+                "type": "order",
+                "room": str(booking['room_number']),
+                "items": items,
+                "total_price": sum(v['qty'] * v['price'] for v in items.values())
+            }
+            messages.append({"web_app_data": {"button_text": "Меню", "data": json.dumps(payload)}})
+        if rng.random() < 0.3:
+            payload = {"type": "feedback", "rating": rng.randint(1, 5), "text": "Отзыв"}
+            messages.append({"web_app_data": {"button_text": "Меню", "data": json.dumps(payload)}})
+        stories.append((user, messages))
+
+    pending = [[user, list(messages)] for user, messages in stories]
+    update_id = 0
+    while pending:
+        story = rng.choice(pending)
+        user, messages = story
+        update_id += 1
+        yield {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user['id'], "type": "private"},
+                "from": user,
+                **messages.pop(0)
+            }
+        }
+        if not messages:
+            pending.remove(story)
+
+def chat_id_of(update):
+    event = update.event
+    chat = getattr(event, 'chat', None)
+    return chat.id if chat else update.update_id
+
+async def replay(bot, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    # asyncio locks are FIFO, so one chat's updates run in file order
+    chat_locks = {}
+
+    async def feed(update):
+        async with semaphore:
+            await bot_module.dp.feed_update(bot, update)
+
+    async def feed_in_order(update, lock):
+        async with lock:
+            await feed(update)
+
+    tasks = []
+    for update in updates:
+        lock = chat_locks.setdefault(chat_id_of(update), asyncio.Lock())
+        tasks.append(asyncio.create_task(feed_in_order(update, lock)))
+        # Let the task queue on its chat lock before the next update is scheduled
+        await asyncio.sleep(0)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    return sum(1 for result in results if isinstance(result, Exception))
+
+async def main(args):
+    logging.basicConfig(level=logging.WARNING)
+    temp_dir = use_temp_database()
+    session = RecordingSession(args.telegram_latency / 1000)
+    bot = Bot(token=BENCH_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    stats = HandlerStats()
+    bot_module.dp.message.middleware(stats)
+    count_queries()
+
+    await db.open_pool()
+    await db.init_db()
+    await db.start_writer()
+    try:
+        rng = make_rng(args.seed)
+        data = await seed(rng, rooms=args.rooms, bookings=args.bookings, orders=args.orders, menu=args.menu)
+
+        if args.input:
+            with open(args.input) as f:
+                raw = [json.loads(line) for line in f if line.strip()]
+        else:
+            raw = list(synthetic_updates(rng, args.synthetic, data))
+            if args.save:
+                with open(args.save, 'w') as f:
+                    for update in raw:
+                        f.write(json.dumps(update, ensure_ascii=False) + '\n')
+        updates = [Update.model_validate(update, context={"bot": bot}) for update in raw]
+
+        started = time.perf_counter()
+        failed = await replay(bot, updates, args.concurrency)
+        elapsed = time.perf_counter() - started
+    finally:
+        await db.stop_writer()
+        await db.close_pool()
+        temp_dir.cleanup()
+
+    handlers = {}
+    for name, latencies in stats.latencies.items():
+        queries = stats.queries[name]
+        handlers[name] = {
+            **summarize(latencies, elapsed),
+            "errors": stats.errors.get(name, 0),
+            "queries_total": sum(queries),
+            "queries_mean": round(sum(queries) / len(queries), 2),
+            "queries_max": max(queries)
+        }
+    handled = sum(len(latencies) for latencies in stats.latencies.values())
+    result = {
+        "benchmark": "replay",
+        "config": {key: value for key, value in vars(args).items() if key not in ('output', 'save')},
+        "environment": environment(),
+        "updates": len(updates),
+        "handled": handled,
+        "unhandled": len(updates) - handled,
+        "failed": failed,
+        "duration_seconds": round(elapsed, 3),
+        "updates_per_second": round(len(updates) / elapsed, 2) if elapsed else None,
+        "handlers": handlers,
+        "bot_api_calls": session.calls
+    }
+    write_result(result, args.output)
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay Telegram updates through the dispatcher")
+    parser.add_argument('input', nargs='?', help="JSONL file of Update objects")
+    parser.add_argument('--synthetic', type=int, default=1000, help="guests in the generated mix (no input file)")
+    parser.add_argument('--save', help="write the generated updates here")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--bookings', type=int, default=2000)
+    parser.add_argument('--orders', type=int, default=0)
+    parser.add_argument('--menu', type=int, default=30)
+    parser.add_argument('--telegram-latency', type=float, default=0, help="fake Bot API delay, ms")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
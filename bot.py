@@ -4,76 +4,314 @@ import sys
 import json
 from os import getenv
 import re
+import csv
+import io
+import zlib
+import time
+import hashlib
 from datetime import datetime
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, WebAppInfo, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from aiogram.utils.markdown import hbold
+from aiogram.utils.markdown import hbold, html_decoration
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.memory import SimpleEventIsolation
 from aiohttp import web
 from pathlib import Path
 
 import database as db
+from assets import CompressedBody, StaticFile, etag_matches
+from events import EventHub, handle_events
+from notifications import OutboxDispatcher
+from webhook import WebhookReceiver
+from storage import SQLiteStorage
+from workers import follow_other_workers, graceful_shutdown, run_workers
+import metrics
 
 # Configuration
 TOKEN = "8353595718:AAEN6_8rF3feUhWOzgulM2Ns_HLYI2c45bw" # Placeholder
 ADMIN_ID = int(getenv("ADMIN_ID", 627977881))
+# Orders and reviews arriving within this many seconds reach the admin as one digest (0 = send each at once)
+ADMIN_DIGEST_WINDOW = int(getenv("ADMIN_DIGEST_WINDOW", 60))
+# Periodic totals for the admin, in seconds (0 = off)
+ADMIN_SUMMARY_INTERVAL = int(getenv("ADMIN_SUMMARY_INTERVAL", 0))
+# Reviews rated this or lower are urgent and skip the digest
+URGENT_RATING = int(getenv("URGENT_RATING", 3))
+# DEV_MODE=1 re-reads changed static files without a restart
+DEV_MODE = getenv("DEV_MODE") == "1"
 WEB_SERVER_HOST = "0.0.0.0"
-WEB_SERVER_PORT = 8080
+WEB_SERVER_PORT = int(getenv("PORT", 8080))
+# WORKERS>1 forks that many server processes sharing the port (SO_REUSEPORT)
+WORKERS = int(getenv("WORKERS", 1))
+# Point at a local fake Bot API for testing, e.g. http://127.0.0.1:8081
+TELEGRAM_API_URL = getenv("TELEGRAM_API_URL")
 BASE_URL = "https://divinely-golden-potoroo.cloudpub.ru"
-
-dp = Dispatcher()
+# BOT_MODE=webhook receives updates on this server at WEBHOOK_PATH; polling stays the fallback
+BOT_MODE = getenv("BOT_MODE", "polling")
+WEBHOOK_PATH = "/telegram/webhook"
+# Same value in every process; by default derived from the token so it is stable too
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
+WEBHOOK_CONCURRENCY = int(getenv("WEBHOOK_CONCURRENCY", 32))
+
+# FSM state lives in SQLite so it survives restarts and is shared between workers;
+# one chat's updates are handled one at a time within a process
+dp = Dispatcher(storage=SQLiteStorage(), events_isolation=SimpleEventIsolation())
+dp.message.middleware(metrics.HandlerTimer())
+
+@dp.update.outer_middleware()
+async def lookup_scope_middleware(handler, event, data):
+    # Repeated user/booking lookups within one update hit the database once
+    with db.lookup_scope():
+        return await handler(event, data)
+# Per-function call counts, latency and rows for everything in database.py
+metrics.instrument_module(db)
+hub = EventHub()
+outbox = OutboxDispatcher()
+webhook = WebhookReceiver(dp, WEBHOOK_SECRET, WEBHOOK_CONCURRENCY)
 
 # --- Web Server Handlers ---
 
 BASE_DIR = Path(__file__).parent
 
+# Loaded, hashed and gzip/brotli-compressed once at import
+guest_page = StaticFile(BASE_DIR / 'static' / 'guest_index.html', reload=DEV_MODE)
+admin_page = StaticFile(BASE_DIR / 'static' / 'admin_pms.html', reload=DEV_MODE)
+
+# The guest page with the menu inlined, rendered and compressed once per (menu version, template).
+# The room is not part of it: the page reads it from its own URL.
+BOOTSTRAP_PLACEHOLDER = b'<script id="bootstrap" type="application/json"></script>'
+_guest_page = None
+_guest_page_lock = asyncio.Lock()
+
+async def render_guest_page():
+    global _guest_page
+    template = guest_page.get()
+    version = db.get_catalog_version('menu')
+    key = (version, template.etags['identity'])
+    if _guest_page is not None and _guest_page[0] == key:
+        return _guest_page[1]
+
+    # One render after a menu edit; concurrent requests wait for it instead of compressing too
+    async with _guest_page_lock:
+        if _guest_page is not None and _guest_page[0] == key:
+            return _guest_page[1]
+        menu_json, _ = await db.get_menu_json()
+        bootstrap = b'{"menu": ' + menu_json + b'}'
+        # Nothing in the data may close the script element
+        bootstrap = bootstrap.replace(b'</', b'<\\/')
+        body = template.variants['identity'].replace(
+            BOOTSTRAP_PLACEHOLDER, BOOTSTRAP_PLACEHOLDER.replace(b'></', b'>' + bootstrap + b'</')
+        )
+        # Strongest brotli/gzip take tens of ms on a large menu: keep them off the event loop
+        page = await asyncio.to_thread(CompressedBody, body)
+        # A menu edit committed while we were rendering: serve this one, don't keep it
+        if version == db.get_catalog_version('menu'):
+            _guest_page = (key, page)
+    return page
+
 async def handle_guest_page(request):
-    return web.FileResponse(BASE_DIR / 'static' / 'guest_index.html')
+    page = await render_guest_page()
+    return page.response(request)
 
 async def handle_admin_page(request):
-    return web.FileResponse(BASE_DIR / 'static' / 'admin_pms.html')
+    return admin_page.response(request)
 
 # --- API Endpoints ---
 
 # Bookings
+MAX_PAGE_SIZE = 1000
+
+def parse_date_param(request, name):
+    value = request.query.get(name)
+    if not value:
+        return None
+    # Raises ValueError on anything that is not YYYY-MM-DD
+    return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+
 async def handle_get_bookings(request):
-    bookings = await db.get_bookings()
-    return web.json_response([dict(b) for b in bookings])
+    # The revision changes with every booking/order/cleaning write, so revision + query
+    # identifies the response body and lets us answer 304 before touching the rows.
+    rev = await db.get_revision()
+    etag = f'"{rev}-{zlib.crc32(request.query_string.encode()):08x}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'X-Revision': str(rev)}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+
+    if 'since' in request.query:
+        # Incremental feed: everything changed or deleted after the client's revision.
+        # Window filters do not apply here, a booking may have moved out of the window.
+        # Past db.MAX_FEED_CHANGES rows it is just {"rev", "resync": true}: reload the window.
+        try:
+            since = int(request.query['since'])
+        except ValueError:
+            return web.json_response({"status": "error", "message": "Invalid since"}, status=400)
+        changes = await db.get_booking_changes(since)
+        headers['X-Revision'] = str(changes['rev'])
+        return web.json_response(changes, headers=headers)
 
-async def handle_add_booking(request):
     try:
-        data = await request.json()
-        cost_per_night = data.get('cost_per_night', 0)
-        paid_amount = data.get('paid_amount', 0)
-        # Pass phone if present
-        phone = data.get('phone')
-        await db.add_booking(
+        date_from = parse_date_param(request, 'from')
+        date_to = parse_date_param(request, 'to')
+        room = request.query.get('room')
+        room_number = int(room) if room else None
+        limit = request.query.get('limit')
+        limit = min(int(limit), MAX_PAGE_SIZE) if limit else None
+        offset = int(request.query.get('offset', 0))
+        if (limit is not None and limit < 1) or offset < 0:
+            raise ValueError
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid query parameters"}, status=400)
+
+    bookings = await db.get_bookings(date_from, date_to, room_number, limit, offset)
+    return web.json_response([dict(b) for b in bookings], headers=headers)
+
+MAX_GRID_DAYS = 62
+
+async def handle_get_grid(request):
+    try:
+        start = parse_date_param(request, 'start') or datetime.now().strftime("%Y-%m-%d")
+        days = int(request.query.get('days', 7))
+        if not 1 <= days <= MAX_GRID_DAYS:
+            raise ValueError
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid query parameters"}, status=400)
+
+    body, etag = await db.get_grid_json(start, days)
+    return cached_json_response(request, body, etag)
+
+async def handle_availability(request):
+    try:
+        date_from = parse_date_param(request, 'from')
+        date_to = parse_date_param(request, 'to')
+        if not date_from or not date_to or date_to <= date_from:
+            raise ValueError
+    except ValueError:
+        return web.json_response({"status": "error", "message": "from and to (YYYY-MM-DD, to > from) required"}, status=400)
+
+    rooms = await db.get_available_rooms(date_from, date_to)
+    return web.json_response({"from": date_from, "to": date_to, "rooms": rooms})
+
+MAX_REPORT_DAYS = 3660
+
+async def handle_reports(request):
+    # Served from daily_stats: cost depends on the range, not on how much history there is
+    try:
+        date_to = parse_date_param(request, 'to') or datetime.now().strftime("%Y-%m-%d")
+        date_from = parse_date_param(request, 'from') or date_to[:8] + "01"
+        days = (datetime.strptime(date_to, "%Y-%m-%d") - datetime.strptime(date_from, "%Y-%m-%d")).days + 1
+        if not 1 <= days <= MAX_REPORT_DAYS:
+            raise ValueError
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid query parameters"}, status=400)
+
+    return web.json_response(await db.get_daily_report(date_from, date_to))
+
+MAX_SEARCH_PAGE_SIZE = 100
+
+async def handle_search(request):
+    q = request.query.get('q', '').strip()
+    try:
+        limit = min(int(request.query.get('limit', db.SEARCH_PAGE_SIZE)), MAX_SEARCH_PAGE_SIZE)
+        offset = int(request.query.get('offset', 0))
+        if len(q) < 2 or limit < 1 or offset < 0:
+            raise ValueError
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid query parameters"}, status=400)
+
+    results, has_more = await db.search_guests(q, limit, offset)
+    return web.json_response({"q": q, "offset": offset, "limit": limit, "has_more": has_more, "results": results})
+
+# Mutations are written as actions: (app, data) -> result dict. HTTP handlers
+# run one action each; /api/batch runs several inside one transaction.
+class ActionError(Exception):
+    def __init__(self, status, payload):
+        super().__init__(payload.get('message', ''))
+        self.status = status
+        self.payload = payload
+
+def check_stay_dates(data):
+    # Stays are half-open [check_in, check_out): an empty or inverted one would never
+    # overlap anything and slip past the conflict check
+    try:
+        check_in = datetime.strptime(str(data.get('check_in')), "%Y-%m-%d")
+        check_out = datetime.strptime(str(data.get('check_out')), "%Y-%m-%d")
+    except ValueError:
+        raise ActionError(400, {"status": "error", "message": "check_in and check_out must be YYYY-MM-DD"})
+    if check_out <= check_in:
+        raise ActionError(400, {"status": "error", "message": "check_out must be after check_in"})
+    data['check_in'] = check_in.strftime("%Y-%m-%d")
+    data['check_out'] = check_out.strftime("%Y-%m-%d")
+
+def conflict_error(error):
+    # 409 with the overlapping stays; the client may resend with "force": true
+    return ActionError(409, {"status": "conflict", "message": str(error), "conflicts": error.conflicts})
+
+async def send_later(chat_id, text, digest=None):
+    # Queued in the caller's transaction; the outbox dispatcher delivers it after commit.
+    # With a digest entry ({group, line, amount}) it waits out ADMIN_DIGEST_WINDOW and is merged.
+    send_at = 0
+    if digest is not None and ADMIN_DIGEST_WINDOW > 0:
+        send_at = time.time() + ADMIN_DIGEST_WINDOW
+    else:
+        digest = None
+    await db.enqueue_notification(chat_id, text, digest, send_at)
+    db.on_commit(outbox.wake)
+
+def notify_after_commit(event):
+    # Subscribers must never see (or wait for) a transaction that may still roll back
+    db.on_commit(lambda: hub.notify(event))
+
+async def run_action(request, action):
+    data = await request.json()
+    try:
+        result = await action(request.app, data)
+    except ActionError as e:
+        return web.json_response(e.payload, status=e.status)
+    return web.json_response({"status": "ok", **result})
+
+async def add_booking_action(app, data):
+    check_stay_dates(data)
+    cost_per_night = data.get('cost_per_night', 0)
+    paid_amount = data.get('paid_amount', 0)
+    # Pass phone if present
+    phone = data.get('phone')
+    try:
+        booking_id = await db.add_booking(
             data['room_number'],
             data['guest_name'],
             data['check_in'],
             data['check_out'],
             cost_per_night,
             phone=phone,
-            paid_amount=paid_amount
+            paid_amount=paid_amount,
+            allow_overlap=bool(data.get('force'))
         )
+    except db.BookingConflictError as e:
+        raise conflict_error(e)
+
+    # Check if we should create/update a user for this phone
+    if phone:
+        existing_user = await db.get_user_by_phone(phone)
+        if existing_user:
+            # Issue 1: Sync user's room
+            await db.add_user(existing_user['user_id'], existing_user['username'], int(data['room_number']))
+            # Also ensure their ID is on the booking (add_booking already tries to do this)
+        else:
+            # User doesn't exist yet, will be linked when they join via bot
+            pass
 
-        # Check if we should create/update a user for this phone
-        if phone:
-            existing_user = await db.get_user_by_phone(phone)
-            if existing_user:
-                # Issue 1: Sync user's room
-                await db.add_user(existing_user['user_id'], existing_user['username'], int(data['room_number']))
-                # Also ensure their ID is on the booking (add_booking already tries to do this)
-            else:
-                # User doesn't exist yet, will be linked when they join via bot
-                pass
+    notify_after_commit('booking')
+    return {"id": booking_id}
 
-        return web.json_response({"status": "ok"})
+async def handle_add_booking(request):
+    try:
+        return await run_action(request, add_booking_action)
     except Exception as e:
         with open('error.log', 'a') as f:
             import traceback
@@ -81,32 +319,42 @@ async def handle_add_booking(request):
             traceback.print_exc(file=f)
         return web.json_response({"status": "error", "message": str(e)}, status=500)
 
-async def handle_update_booking(request):
-    data = await request.json()
+async def update_booking_action(app, data):
+    # The booking change and the guest's notification commit together
+    async with db.transaction():
+        return await _update_booking(data)
+
+async def _update_booking(data):
     booking_id = data.get('id')
     if not booking_id:
-        return web.json_response({"status": "error", "message": "ID missing"}, status=400)
+        raise ActionError(400, {"status": "error", "message": "ID missing"})
 
     # Fetch old booking to check for room changes
     old_booking = await db.get_booking(booking_id)
     if not old_booking:
-        return web.json_response({"status": "error", "message": "Booking not found"}, status=404)
+        raise ActionError(404, {"status": "error", "message": "Booking not found"})
 
+    check_stay_dates(data)
     new_room_number = data['room_number']
     phone = data.get('phone')
     paid_amount = data.get('paid_amount', 0)
 
     # Update DB
-    await db.update_booking(
-        booking_id,
-        new_room_number,
-        data['guest_name'],
-        data['check_in'],
-        data['check_out'],
-        data.get('cost_per_night', 0),
-        phone,
-        paid_amount
-    )
+    try:
+        await db.update_booking(
+            booking_id,
+            new_room_number,
+            data['guest_name'],
+            data['check_in'],
+            data['check_out'],
+            data.get('cost_per_night', 0),
+            phone,
+            paid_amount,
+            allow_overlap=bool(data.get('force'))
+        )
+    except db.BookingConflictError as e:
+        raise conflict_error(e)
+    notify_after_commit('booking')
 
     # Task 1 & 4: Notify user if room changed
     if str(old_booking['room_number']) != str(new_room_number):
@@ -122,44 +370,48 @@ async def handle_update_booking(request):
                 await db.add_user(user_id, user['username'], int(new_room_number))
 
                 # Send Notification
-                bot = request.app['bot']
-                try:
-                    msg_text = (
-                        f"ℹ️ Ваш номер был изменен на {new_room_number}.\n"
-                        f"Весь расчет теперь ведется по этому номеру."
-                    )
-                    await bot.send_message(user_id, msg_text)
-                except Exception as e:
-                    logging.error(f"Failed to notify user {user_id} of room change: {e}")
+                msg_text = (
+                    f"ℹ️ Ваш номер был изменен на {new_room_number}.\n"
+                    f"Весь расчет теперь ведется по этому номеру."
+                )
+                await send_later(user_id, msg_text)
 
-    return web.json_response({"status": "ok"})
+    return {}
 
-async def handle_delete_booking(request):
-    data = await request.json()
+async def handle_update_booking(request):
+    return await run_action(request, update_booking_action)
+
+async def delete_booking_action(app, data):
     await db.delete_booking(data['id'])
-    return web.json_response({"status": "ok"})
+    notify_after_commit('booking')
+    return {}
 
-async def handle_toggle_cleaning(request):
-    data = await request.json()
+async def handle_delete_booking(request):
+    return await run_action(request, delete_booking_action)
+
+async def toggle_cleaning_action(app, data):
     booking_id = data.get('id')
-    if booking_id:
-        new_status = await db.toggle_booking_cleaning_status(booking_id)
-        return web.json_response({"status": "ok", "is_cleaned": new_status})
-    return web.json_response({"status": "error"}, status=400)
+    if not booking_id:
+        raise ActionError(400, {"status": "error"})
+    new_status = await db.toggle_booking_cleaning_status(booking_id)
+    notify_after_commit('cleaning')
+    return {"is_cleaned": new_status}
 
-async def handle_add_service_to_booking(request):
-    data = await request.json()
+async def handle_toggle_cleaning(request):
+    return await run_action(request, toggle_cleaning_action)
+
+async def add_service_action(app, data):
     booking_id = data.get('booking_id')
     items = data.get('items') # Expected dict or list
     total_price = data.get('total_price')
 
     if not booking_id or not items:
-        return web.json_response({"status": "error", "message": "Missing data"}, status=400)
+        raise ActionError(400, {"status": "error", "message": "Missing data"})
 
     # Get booking to find user_id (if any)
     booking = await db.get_booking(booking_id)
     if not booking:
-         return web.json_response({"status": "error", "message": "Booking not found"}, status=404)
+        raise ActionError(404, {"status": "error", "message": "Booking not found"})
 
     user_id = booking['user_id'] # May be None
 
@@ -168,8 +420,12 @@ async def handle_add_service_to_booking(request):
 
     # Update Booking Extras
     await db.update_booking_extras(booking['room_number'], total_price, booking_id)
+    notify_after_commit('order')
 
-    return web.json_response({"status": "ok"})
+    return {}
+
+async def handle_add_service_to_booking(request):
+    return await run_action(request, add_service_action)
 
 async def handle_get_booking_orders(request):
     booking_id = request.match_info.get('id')
@@ -179,35 +435,244 @@ async def handle_get_booking_orders(request):
     orders = await db.get_orders_by_booking(booking_id)
     return web.json_response([dict(o) for o in orders])
 
+def cached_json_response(request, body, etag):
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='application/json', headers=headers)
+
+# Import / Export
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_ERRORS = 100
+
+async def handle_export(request):
+    table = request.match_info['table']
+    fmt = request.query.get('format', 'csv')
+    if table not in db.EXPORT_TABLES or fmt not in ('csv', 'jsonl'):
+        return web.json_response({"status": "error", "message": "Unknown table or format"}, status=404)
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson',
+        'Content-Disposition': f'attachment; filename="{table}.{fmt}"',
+    })
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    header_sent = False
+    async for columns, rows in db.iter_table(table):
+        buf = io.StringIO()
+        if fmt == 'csv':
+            writer = csv.writer(buf)
+            if not header_sent:
+                writer.writerow(columns)
+                header_sent = True
+            writer.writerows(tuple(row) for row in rows)
+        else:
+            for row in rows:
+                buf.write(json.dumps(dict(row), ensure_ascii=False))
+                buf.write('\n')
+        await response.write(buf.getvalue().encode())
+
+    await response.write_eof()
+    return response
+
+def parse_import_row(record):
+    # Returns a tuple in db.IMPORT_BOOKING_COLUMNS order or raises ValueError
+    room_number = int(record.get('room_number'))
+    guest_name = (record.get('guest_name') or '').strip()
+    if not guest_name:
+        raise ValueError("guest_name is required")
+    check_in = datetime.strptime(str(record.get('check_in')), "%Y-%m-%d").strftime("%Y-%m-%d")
+    check_out = datetime.strptime(str(record.get('check_out')), "%Y-%m-%d").strftime("%Y-%m-%d")
+    if check_out <= check_in:
+        raise ValueError("check_out must be after check_in")
+    return (
+        room_number,
+        guest_name,
+        check_in,
+        check_out,
+        float(record.get('cost_per_night') or 0),
+        record.get('phone') or None,
+        float(record.get('paid_amount') or 0),
+        float(record.get('extras_total') or 0),
+        record.get('status') or 'booked',
+        1 if str(record.get('is_cleaned') or 0) in ('1', 'True', 'true') else 0,
+    )
+
+async def iter_upload_lines(request):
+    if request.content_type.startswith('multipart/'):
+        reader = await request.multipart()
+        part = await reader.next()
+        while part is not None and part.filename is None:
+            part = await reader.next()
+        if part is None:
+            return
+        while True:
+            line = await part.readline()
+            if not line:
+                return
+            yield line
+    else:
+        async for line in request.content:
+            yield line
+
+async def handle_import_bookings(request):
+    fmt = request.query.get('format') or ('jsonl' if 'json' in request.content_type else 'csv')
+    imported = 0
+    errors = []
+    batch = []
+    batch_lines = []
+    first_id = None
+    header = None
+    line_no = 0
+    # ?force=1 imports stays that overlap existing bookings, like "force" on /api/bookings
+    allow_overlap = request.query.get('force') in ('1', 'true')
+
+    def row_error(message, line=None, **extra):
+        if len(errors) < MAX_IMPORT_ERRORS:
+            errors.append({"line": line or line_no, "error": message, **extra})
+
+    async def flush():
+        nonlocal imported, first_id
+        if batch:
+            batch_first_id, conflicts = await db.import_bookings_batch(batch, allow_overlap)
+            if first_id is None:
+                first_id = batch_first_id
+            imported += len(batch) - len(conflicts)
+            for i, overlapping in conflicts.items():
+                row_error(str(db.BookingConflictError(overlapping)), batch_lines[i], conflicts=overlapping)
+            batch.clear()
+            batch_lines.clear()
+
+    relinked = 0
+    try:
+        async for raw in iter_upload_lines(request):
+            line_no += 1
+            try:
+                line = raw.decode('utf-8-sig').strip()
+            except UnicodeDecodeError:
+                # Excel saves "CSV" as CP1251 here; "CSV UTF-8" is the one we read
+                row_error("not UTF-8, save the file as CSV UTF-8")
+                continue
+            if not line:
+                continue
+            try:
+                if fmt == 'jsonl':
+                    record = json.loads(line)
+                else:
+                    values = next(csv.reader([line]))
+                    if header is None:
+                        header = values
+                        continue
+                    record = dict(zip(header, values))
+                batch.append(parse_import_row(record))
+                batch_lines.append(line_no)
+            except (ValueError, TypeError, AttributeError) as e:
+                row_error(str(e))
+                continue
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await flush()
+        await flush()
+    finally:
+        # Committed batches still need their users and orphaned orders, even if the
+        # upload broke off halfway
+        if first_id is not None:
+            relinked = await db.finish_bookings_import(first_id)
+            hub.notify('booking')
+
+    return web.json_response({
+        "status": "ok",
+        "imported": imported,
+        "relinked_orders": relinked,
+        "errors": errors,
+    })
+
 # Rooms
 async def handle_get_rooms(request):
-    rooms = await db.get_rooms()
-    return web.json_response([dict(r) for r in rooms])
+    body, etag = await db.get_rooms_json()
+    return cached_json_response(request, body, etag)
+
+async def add_room_action(app, data):
+    room_id = await db.add_room(data['number'], data['type'], data['price'], "")
+    if room_id is None:
+        raise ActionError(409, {"status": "conflict", "message": f"Room {data['number']} already exists"})
+    return {"id": room_id}
 
 async def handle_add_room(request):
-    data = await request.json()
-    await db.add_room(data['number'], data['type'], data['price'], "")
-    return web.json_response({"status": "ok"})
+    return await run_action(request, add_room_action)
 
-async def handle_delete_room(request):
-    data = await request.json()
+async def delete_room_action(app, data):
     await db.delete_room(data['id'])
-    return web.json_response({"status": "ok"})
+    return {}
+
+async def handle_delete_room(request):
+    return await run_action(request, delete_room_action)
 
 # Menu
 async def handle_get_menu(request):
-    menu = await db.get_menu_items()
-    return web.json_response([dict(m) for m in menu])
+    body, etag = await db.get_menu_json()
+    return cached_json_response(request, body, etag)
+
+async def add_menu_action(app, data):
+    item_id = await db.add_menu_item(data['name'], data['price'], "", data['category'])
+    return {"id": item_id}
 
 async def handle_add_menu(request):
-    data = await request.json()
-    await db.add_menu_item(data['name'], data['price'], "", data['category'])
-    return web.json_response({"status": "ok"})
+    return await run_action(request, add_menu_action)
 
-async def handle_delete_menu(request):
-    data = await request.json()
+async def delete_menu_action(app, data):
     await db.delete_menu_item(data['id'])
-    return web.json_response({"status": "ok"})
+    return {}
+
+async def handle_delete_menu(request):
+    return await run_action(request, delete_menu_action)
+
+# Batch
+BATCH_ACTIONS = {
+    'add_booking': add_booking_action,
+    'update_booking': update_booking_action,
+    'delete_booking': delete_booking_action,
+    'toggle_cleaning': toggle_cleaning_action,
+    'add_service': add_service_action,
+    'add_room': add_room_action,
+    'delete_room': delete_room_action,
+    'add_menu': add_menu_action,
+    'delete_menu': delete_menu_action,
+}
+MAX_BATCH_OPERATIONS = 500
+
+async def handle_batch(request):
+    # {"operations": [{"op": "toggle_cleaning", "data": {"id": 5}}, ...]}: all or nothing
+    payload = await request.json()
+    operations = payload.get('operations') if isinstance(payload, dict) else payload
+    if not isinstance(operations, list) or not operations or len(operations) > MAX_BATCH_OPERATIONS:
+        return web.json_response({"status": "error", "message": "operations must be a non-empty list"}, status=400)
+
+    results = []
+    index = 0
+    try:
+        async with db.transaction():
+            for index, operation in enumerate(operations):
+                if not isinstance(operation, dict):
+                    raise ActionError(400, {"status": "error", "message": "Each operation must be an object"})
+                action = BATCH_ACTIONS.get(operation.get('op'))
+                if action is None:
+                    raise ActionError(400, {"status": "error", "message": f"Unknown op {operation.get('op')!r}"})
+                try:
+                    result = await action(request.app, operation.get('data') or {})
+                except (KeyError, TypeError, ValueError) as e:
+                    raise ActionError(400, {"status": "error", "message": f"Invalid data: {e}"})
+                results.append({"op": operation['op'], "status": "ok", **result})
+    except ActionError as e:
+        # Nothing was committed; report which operation stopped the batch
+        return web.json_response({
+            "status": "error",
+            "failed_index": index,
+            "error": e.payload,
+            "results": results,
+        }, status=e.status)
+
+    return web.json_response({"status": "ok", "results": results})
 
 # --- Bot Handlers ---
 
@@ -350,67 +815,64 @@ async def handle_web_app_data(message: Message, bot: Bot):
                 await message.answer("⛔ Заказ завтрака доступен только с 12:00 до 19:00.")
                 return
 
-        # Save to DB
-        # We need booking_id for Issue 2 (link orders to booking)
-        # Try to find active booking
+        # Save to DB: booking lookup (by user, then by room), order and extras in one transaction
         room_num = None
-        booking_id = None
-
-        # Prioritize finding booking by user_id (fixes issue with room moves/stale client data)
-        user_active_booking = await db.get_active_booking_by_user(message.from_user.id)
-        if user_active_booking:
-            booking_id = user_active_booking['id']
-            room_num = user_active_booking['room_number']
-        elif 'room' in data:
-            # Fallback: try to find by room if user has no linked booking
+        if 'room' in data:
             try:
                 room_num = int(data['room'])
-                active_booking = await db.get_active_booking_by_room(room_num)
-                if active_booking:
-                    booking_id = active_booking['id']
             except ValueError:
                 pass
 
-        # Fetch phone for order binding
-        user_phone = None
-        user = await db.get_user(message.from_user.id)
-        if user:
-            user_phone = user.get('phone')
-
-        order_id = await db.save_order(message.from_user.id, data['items'], data['total_price'], booking_id, phone=user_phone)
-
-        # Update active booking extras
-        if room_num:
-            await db.update_booking_extras(room_num, data['total_price'], booking_id)
+        async with db.transaction():
+            placed = await db.place_order(message.from_user.id, data['items'], data['total_price'], room_num)
+
+            # Notify Admin (queued in the order's transaction)
+            room = html_decoration.quote(str(data.get('room', '???'))) # raw WebApp input
+            items_str = ""
+            for k, v in data['items'].items():
+                items_str += f"- {v['name']} x{v['qty']} ({v['price']*v['qty']}₽)\n"
+
+            phone_info = f" ({placed['phone']})" if placed['phone'] else ""
+
+            admin_text = (
+                f"🔔 <b>Новый заказ!</b>\n"
+                f"Комната: {room}\n"
+                f"Гость: @{message.from_user.username or message.from_user.id}{phone_info}\n\n"
+                f"{items_str}\n"
+                f"<b>Итого: {data['total_price']} ₽</b>"
+            )
+            items_short = ", ".join(f"{v['name']} x{v['qty']}" for v in data['items'].values())
+            digest = {
+                "group": f"Комната {room}",
+                "line": html_decoration.quote(
+                    f"@{message.from_user.username or message.from_user.id}{phone_info}: "
+                    f"{items_short} — {data['total_price']} ₽"
+                ),
+                "amount": data['total_price']
+            }
+            await send_later(ADMIN_ID, admin_text, digest)
+        hub.notify('order')
 
         # Reply to User
-        await message.answer(f"✅ Заказ #{order_id} принят! Оплата на кассе.\nСумма: {data['total_price']} ₽")
-
-        # Notify Admin
-        room = data.get('room', '???')
-        items_str = ""
-        for k, v in data['items'].items():
-            items_str += f"- {v['name']} x{v['qty']} ({v['price']*v['qty']}₽)\n"
-
-        # Fetch user phone for admin info
-        user = await db.get_user(message.from_user.id)
-        phone_info = f" ({user['phone']})" if user and user.get('phone') else ""
+        await message.answer(f"✅ Заказ #{placed['order_id']} принят! Оплата на кассе.\nСумма: {data['total_price']} ₽")
 
+    elif data['type'] == 'feedback':
+        # Save Review together with the admin notification
         admin_text = (
-            f"🔔 <b>Новый заказ!</b>\n"
-            f"Комната: {room}\n"
-            f"Гость: @{message.from_user.username or message.from_user.id}{phone_info}\n\n"
-            f"{items_str}\n"
-            f"<b>Итого: {data['total_price']} ₽</b>"
+            f"💬 <b>Новый отзыв!</b>\n"
+            f"От: @{message.from_user.username}\n"
+            f"Оценка: {'⭐' * data['rating']}\n"
+            f"Текст: {data['text']}"
         )
-        try:
-            await bot.send_message(ADMIN_ID, admin_text)
-        except Exception as e:
-            logging.error(f"Failed to notify admin: {e}")
-
-    elif data['type'] == 'feedback':
-        # Save Review
-        await db.add_review(message.from_user.id, data['rating'], data['text'])
+        digest = None
+        if data['rating'] > URGENT_RATING:
+            digest = {
+                "group": "Отзывы",
+                "line": html_decoration.quote(f"@{message.from_user.username} {'⭐' * data['rating']}: {data['text']}")
+            }
+        async with db.transaction():
+            await db.add_review(message.from_user.id, data['rating'], data['text'])
+            await send_later(ADMIN_ID, admin_text, digest)
 
         # Reply to User
         if data['rating'] >= 4:
@@ -418,28 +880,30 @@ async def handle_web_app_data(message: Message, bot: Bot):
         else:
             await message.answer("Спасибо за отзыв. Мы обязательно примем меры.")
 
-        # Notify Admin
-        admin_text = (
-            f"💬 <b>Новый отзыв!</b>\n"
-            f"От: @{message.from_user.username}\n"
-            f"Оценка: {'⭐' * data['rating']}\n"
-            f"Текст: {data['text']}"
-        )
-        try:
-            await bot.send_message(ADMIN_ID, admin_text)
-        except Exception as e:
-            logging.error(f"Failed to notify admin: {e}")
-
 # --- Main Execution ---
 
 async def start_bot_safely(bot):
     try:
+        # getUpdates is refused while a webhook is registered
+        await bot.delete_webhook()
         await dp.start_polling(bot)
     except Exception as e:
         logging.error(f"Bot polling failed: {e}")
 
 async def on_startup(app):
+    await db.open_pool()
     await db.init_db()
+    await db.start_writer()
+    app['background'] = []
+    if WORKERS > 1:
+        app['background'].append(asyncio.create_task(follow_other_workers(app['hub'])))
+    # Singletons (backfills, outbox, seeding, receiving updates) run in the primary worker only
+    if not app['primary']:
+        return
+
+    # Chunked data migrations run while we serve
+    app['background'].append(asyncio.create_task(db.run_backfills()))
+    await outbox.start(app['bot'], ADMIN_ID, ADMIN_SUMMARY_INTERVAL)
     # Seed basic data if empty
     rooms = await db.get_rooms()
     if not rooms:
@@ -452,21 +916,45 @@ async def on_startup(app):
         await db.add_menu_item("Завтрак Континентальный", 500, "", "food")
         await db.add_menu_item("Кофе", 150, "", "drinks")
 
-    asyncio.create_task(start_bot_safely(app['bot']))
-
-async def main():
-    logging.basicConfig(level=logging.INFO)
-
-    bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-
-    app = web.Application()
+    if app['receive_updates']:
+        use_webhook = BOT_MODE == "webhook" and await webhook.start(app['bot'], f"{BASE_URL}{WEBHOOK_PATH}")
+        if not use_webhook:
+            asyncio.create_task(start_bot_safely(app['bot']))
+
+async def on_shutdown(app):
+    await app['hub'].close()
+    await webhook.stop(app['bot'])
+
+async def on_cleanup(app):
+    # Safe to interrupt: backfill progress is committed per chunk
+    for task in app['background']:
+        task.cancel()
+    await asyncio.gather(*app['background'], return_exceptions=True)
+    await outbox.stop()
+    await db.stop_writer()
+    await db.close_pool()
+
+@web.middleware
+async def lookup_scope_http(request, handler):
+    with db.lookup_scope():
+        return await handler(request)
+
+def create_app(bot, receive_updates=True, primary=True):
+    # receive_updates=False serves only HTTP; the caller feeds updates to dp itself (benchmarks)
+    app = web.Application(middlewares=[metrics.http_middleware, lookup_scope_http])
     app['bot'] = bot
+    app['hub'] = hub
+    app['receive_updates'] = receive_updates
+    app['primary'] = primary
 
     # Routes
     app.router.add_get('/guest', handle_guest_page)
+    if BOT_MODE == "webhook":
+        app.router.add_post(WEBHOOK_PATH, webhook.handle)
     app.router.add_get('/admin', handle_admin_page)
 
     # API
+    app.router.add_get('/metrics', metrics.handle_metrics)
     app.router.add_get('/api/bookings', handle_get_bookings)
     app.router.add_post('/api/bookings', handle_add_booking)
     app.router.add_put('/api/bookings', handle_update_booking)
@@ -474,6 +962,14 @@ async def main():
     app.router.add_post('/api/bookings/toggle_cleaning', handle_toggle_cleaning)
     app.router.add_post('/api/bookings/services', handle_add_service_to_booking)
     app.router.add_get('/api/bookings/{id}/orders', handle_get_booking_orders)
+    app.router.add_get('/api/events', handle_events)
+    app.router.add_get('/api/grid', handle_get_grid)
+    app.router.add_get('/api/availability', handle_availability)
+    app.router.add_get('/api/reports', handle_reports)
+    app.router.add_get('/api/search', handle_search)
+    app.router.add_get('/api/export/{table}', handle_export)
+    app.router.add_post('/api/import/bookings', handle_import_bookings)
+    app.router.add_post('/api/batch', handle_batch)
 
     app.router.add_get('/api/rooms', handle_get_rooms)
     app.router.add_post('/api/rooms', handle_add_room)
@@ -484,19 +980,51 @@ async def main():
     app.router.add_delete('/api/menu', handle_delete_menu)
 
     app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def create_bot():
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    return Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+async def main(worker=0):
+    # force: the parent process may already have configured logging before forking us
+    logging.basicConfig(level=logging.INFO, format=f"[worker {worker}] %(levelname)s:%(name)s:%(message)s", force=True)
+
+    if WORKERS > 1:
+        # Writers of all workers queue on one lock file instead of SQLite's busy polling
+        db.WRITE_LOCK_PATH = f"{db.DB_NAME}.write-lock"
+    bot = create_bot()
+    app = create_app(bot, primary=worker == 0)
 
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT)
+    site = web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT, reuse_port=WORKERS > 1)
     await site.start()
 
     print(f"Server started at {BASE_URL}")
 
-    while True:
-        await asyncio.sleep(3600)
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await runner.cleanup()
 
-if __name__ == "__main__":
+def run_worker(worker):
+    graceful_shutdown()
     try:
-        asyncio.run(main())
+        asyncio.run(main(worker))
     except KeyboardInterrupt:
         pass
+
+if __name__ == "__main__":
+    if WORKERS > 1:
+        # Migrate once before the workers race for it
+        asyncio.run(db.init_db())
+        try:
+            run_workers(WORKERS, run_worker)
+        except KeyboardInterrupt:
+            pass
+    else:
+        run_worker(0)
@@ -1,109 +1,774 @@
+import asyncio
 import aiosqlite
+import fcntl
+import hashlib
 import json
-from datetime import datetime
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
+from os import getenv
 import logging
+import sys
+import time
 
 DB_NAME = "hotel.db"
+POOL_SIZE = int(getenv("DB_POOL_SIZE", 4))
 
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                current_room INTEGER,
-                phone TEXT UNIQUE
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                items TEXT,
-                total_price REAL,
-                status TEXT DEFAULT 'new',
-                created_at TEXT,
-                booking_id INTEGER
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS bookings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                room_number INTEGER,
-                guest_name TEXT,
-                check_in TEXT,
-                check_out TEXT,
-                status TEXT DEFAULT 'booked',
-                cost_per_night REAL DEFAULT 0,
-                extras_total REAL DEFAULT 0,
-                is_cleaned BOOLEAN DEFAULT 0,
-                phone TEXT,
-                user_id INTEGER,
-                paid_amount REAL DEFAULT 0
-            )
-        """)
+# Applied once to every connection we open
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+)
 
-        # Migrations
-        columns = {
-            'bookings': [
-                ('cost_per_night', 'REAL DEFAULT 0'),
-                ('extras_total', 'REAL DEFAULT 0'),
-                ('is_cleaned', 'BOOLEAN DEFAULT 0'),
-                ('phone', 'TEXT'),
-                ('user_id', 'INTEGER'),
-                ('paid_amount', 'REAL DEFAULT 0')
-            ],
-            'users': [
-                ('phone', 'TEXT')
-            ],
-            'orders': [
-                ('booking_id', 'INTEGER'),
-                ('phone', 'TEXT')
-            ]
-        }
-
-        for table, cols in columns.items():
-            for col_name, col_type in cols:
-                try:
-                    await db.execute(f"ALTER TABLE {table} ADD COLUMN {col_name} {col_type}")
-                except Exception as e:
-                    # logging.warning(f"Migration warning: Column {col_name} in {table} could not be added (might exist): {e}")
-                    pass
-
-        # New Tables
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS menu_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                price REAL,
-                description TEXT,
-                category TEXT,
-                is_available BOOLEAN DEFAULT 1
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS rooms (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                number INTEGER UNIQUE,
-                type TEXT,
-                price REAL,
-                description TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS reviews (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                rating INTEGER,
-                text TEXT,
-                created_at TEXT
-            )
-        """)
+# --- Connections ---
+async def _open_connection():
+    conn = await aiosqlite.connect(DB_NAME)
+    conn.row_factory = aiosqlite.Row
+    for pragma in CONNECTION_PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+class ConnectionPool:
+    def __init__(self, size):
+        self.size = size
+        self._connections = []
+        self._idle = asyncio.Queue()
+
+    async def open(self):
+        for _ in range(self.size):
+            conn = await _open_connection()
+            self._connections.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections = []
+        self._idle = asyncio.Queue()
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            # Never hand a half-finished transaction to the next borrower
+            if conn.in_transaction:
+                await conn.rollback()
+            self._idle.put_nowait(conn)
+
+_pool = None
+
+async def open_pool(size=POOL_SIZE):
+    global _pool
+    if _pool is None:
+        pool = ConnectionPool(size)
+        await pool.open()
+        _pool = pool
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+class _TxState:
+    def __init__(self, conn):
+        self.conn = conn
+        self.active = True
+        self.depth = 0
+        self.callbacks = []
+
+# The write transaction the current task is inside of, if any
+_current_tx = ContextVar('current_tx', default=None)
+
+def _active_tx():
+    state = _current_tx.get()
+    return state if state is not None and state.active else None
+
+@asynccontextmanager
+async def _connect():
+    state = _active_tx()
+    if state is not None:
+        # Reads inside a write see the transaction's own changes
+        yield state.conn
+    elif _pool is not None:
+        async with _pool.acquire() as conn:
+            yield conn
+    else:
+        # No pool (scripts, one-off maintenance): plain short-lived connection
+        conn = await _open_connection()
+        try:
+            yield conn
+        finally:
+            await conn.close()
+
+# --- Writer ---
+# SQLite has a single writer anyway, so one task owns the write connection.
+# Write requests that arrive within WRITE_BATCH_WINDOW share one transaction
+# (one fsync); each runs in its own savepoint so a failing caller only rolls
+# back its own statements.
+WRITE_BATCH_WINDOW = 0.002
+WRITE_BATCH_MAX = 64
+# With several worker processes their writers also take this file lock around each
+# batch: waiters queue in the kernel and wake on release instead of polling SQLite's
+# busy handler (which sleeps up to 100 ms between tries).
+WRITE_LOCK_PATH = None
+
+class _WriteRequest:
+    def __init__(self):
+        loop = asyncio.get_running_loop()
+        self.ready = loop.create_future()
+        self.done = loop.create_future()
+        self.committed = loop.create_future()
+
+class Writer:
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._conn = None
+        self._task = None
+        self._lock_file = None
+
+    async def start(self):
+        self._conn = await _open_connection()
+        if WRITE_LOCK_PATH:
+            self._lock_file = open(WRITE_LOCK_PATH, 'a')
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Finish whatever is queued, then close
+        self._queue.put_nowait(None)
+        await self._task
+        await self._conn.close()
+        if self._lock_file:
+            self._lock_file.close()
+
+    @asynccontextmanager
+    async def transaction(self):
+        request = _WriteRequest()
+        self._queue.put_nowait(request)
+        try:
+            conn = await request.ready
+        except BaseException as e:
+            # Gave up before our turn: the writer will skip us
+            if not request.done.done():
+                request.done.set_result(e)
+            raise
+        try:
+            yield conn
+        except BaseException as e:
+            request.done.set_result(e)
+            raise
+        request.done.set_result(None)
+        await request.committed
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            request = await self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = loop.time() + WRITE_BATCH_WINDOW
+            while len(batch) < WRITE_BATCH_MAX:
+                if self._queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self._queue.get_nowait()
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+            try:
+                if self._lock_file:
+                    await asyncio.to_thread(fcntl.flock, self._lock_file, fcntl.LOCK_EX)
+                    try:
+                        await self._apply(batch)
+                    finally:
+                        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                else:
+                    await self._apply(batch)
+            except Exception as e:
+                # E.g. SQLite rolled the whole transaction back (SQLITE_FULL, IOERR) and a
+                # savepoint is gone. Fail this batch, but the writer must keep serving.
+                await self._abort(batch, e)
+
+    async def _abort(self, batch, error):
+        logging.error(f"Write batch failed: {error}")
+        try:
+            await self._conn.rollback()
+        except Exception as e:
+            logging.error(f"Rollback after failed write batch failed: {e}")
+        for request in batch:
+            if not request.ready.done():
+                request.ready.set_exception(error)
+            elif not request.committed.done():
+                request.committed.set_exception(error)
+
+    async def _apply(self, batch):
+        conn = self._conn
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            for request in batch:
+                if not request.ready.done():
+                    request.ready.set_exception(e)
+            return
+
+        applied = []
+        for request in batch:
+            if request.done.done():
+                continue
+            await conn.execute("SAVEPOINT request")
+            request.ready.set_result(conn)
+            error = await request.done
+            if error is None:
+                await conn.execute("RELEASE request")
+                applied.append(request)
+            else:
+                await conn.execute("ROLLBACK TO request")
+                await conn.execute("RELEASE request")
+
+        try:
+            await conn.commit()
+        except Exception as e:
+            logging.error(f"Write batch commit failed: {e}")
+            await conn.rollback()
+            for request in applied:
+                request.committed.set_exception(e)
+        else:
+            for request in applied:
+                request.committed.set_result(None)
+
+_writer = None
+
+async def start_writer():
+    global _writer
+    if _writer is None:
+        writer = Writer()
+        await writer.start()
+        _writer = writer
+
+async def stop_writer():
+    global _writer
+    if _writer is not None:
+        writer, _writer = _writer, None
+        await writer.stop()
+
+@asynccontextmanager
+async def _direct_transaction():
+    # No writer task (scripts): take the write lock on our own connection
+    async with _connect() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
         await db.commit()
 
+@asynccontextmanager
+async def _transaction():
+    state = _active_tx()
+    if state is not None:
+        # Nested write: join the outer transaction under a savepoint
+        state.depth += 1
+        name = f"nested_{state.depth}"
+        await state.conn.execute(f"SAVEPOINT {name}")
+        try:
+            yield state.conn
+        except BaseException:
+            await state.conn.execute(f"ROLLBACK TO {name}")
+            await state.conn.execute(f"RELEASE {name}")
+            raise
+        finally:
+            state.depth -= 1
+        await state.conn.execute(f"RELEASE {name}")
+        return
+
+    source = _writer.transaction() if _writer is not None else _direct_transaction()
+    async with source as conn:
+        state = _TxState(conn)
+        token = _current_tx.set(state)
+        try:
+            yield conn
+        finally:
+            state.active = False
+            _current_tx.reset(token)
+    for callback in state.callbacks:
+        callback()
+
+def transaction():
+    # Unit of work for callers outside this module: every database call made
+    # inside it joins the same transaction and commits (or rolls back) once
+    return _transaction()
+
+def on_commit(callback):
+    # Run callback once the surrounding write is durable (right away outside one)
+    state = _active_tx()
+    if state is None:
+        callback()
+    else:
+        state.callbacks.append(callback)
+
+# --- Schema migrations ---
+# PRAGMA user_version counts the applied migrations. Each step runs once, in one
+# transaction with its version bump. Slow data work (backfills, index builds on big
+# tables) is scheduled by the step as a backfill and done after startup: data copies
+# in chunks, index builds one index per chunk (SQLite cannot build one in pieces).
+
+LEGACY_COLUMNS = {
+    'bookings': [
+        ('cost_per_night', 'REAL DEFAULT 0'),
+        ('extras_total', 'REAL DEFAULT 0'),
+        ('is_cleaned', 'BOOLEAN DEFAULT 0'),
+        ('phone', 'TEXT'),
+        ('user_id', 'INTEGER'),
+        ('paid_amount', 'REAL DEFAULT 0'),
+        ('rev', 'INTEGER DEFAULT 0')
+    ],
+    'users': [
+        ('phone', 'TEXT')
+    ],
+    'orders': [
+        ('booking_id', 'INTEGER'),
+        ('phone', 'TEXT')
+    ],
+    'outbox': [
+        ('digest', 'TEXT')
+    ]
+}
+
+async def _add_missing_columns(db, table, columns):
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        existing = {row[1] for row in await cursor.fetchall()}
+    for name, col_type in columns:
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_bookings_room_dates ON bookings(room_number, check_in, check_out)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_user_check_in ON bookings(user_id, check_in)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_phone ON bookings(phone)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_check_out ON bookings(check_out)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_room_check_out ON bookings(room_number, check_out, check_in)",
+    "CREATE INDEX IF NOT EXISTS idx_bookings_rev ON bookings(rev)",
+    "CREATE INDEX IF NOT EXISTS idx_booking_tombstones_rev ON booking_tombstones(rev)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_booking ON orders(booking_id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_phone ON orders(phone)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_reviews_created_at ON reviews(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, next_attempt_at)",
+    "CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox(chat_id, status, id)",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_menu_item ON order_items(menu_item_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_order_items_created_at ON order_items(created_at)",
+]
+
+async def _migration_1_baseline(db):
+    # Also adopts databases from before versioning: everything here is idempotent
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            current_room INTEGER,
+            phone TEXT UNIQUE
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            items TEXT,
+            total_price REAL,
+            status TEXT DEFAULT 'new',
+            created_at TEXT,
+            booking_id INTEGER
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_number INTEGER,
+            guest_name TEXT,
+            check_in TEXT,
+            check_out TEXT,
+            status TEXT DEFAULT 'booked',
+            cost_per_night REAL DEFAULT 0,
+            extras_total REAL DEFAULT 0,
+            is_cleaned BOOLEAN DEFAULT 0,
+            phone TEXT,
+            user_id INTEGER,
+            paid_amount REAL DEFAULT 0,
+            rev INTEGER DEFAULT 0
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS menu_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            price REAL,
+            description TEXT,
+            category TEXT,
+            is_available BOOLEAN DEFAULT 1
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS rooms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            number INTEGER UNIQUE,
+            type TEXT,
+            price REAL,
+            description TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            rating INTEGER,
+            text TEXT,
+            created_at TEXT
+        )
+    """)
+
+    # Change feed: global revision counter and deleted booking ids
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    """)
+    await db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0)")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS booking_tombstones (
+            booking_id INTEGER PRIMARY KEY,
+            rev INTEGER
+        )
+    """)
+
+    # One row per cart line, written together with its order
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            menu_item_id INTEGER,
+            name TEXT,
+            qty INTEGER,
+            unit_price REAL,
+            created_at TEXT
+        )
+    """)
+
+    # Outgoing Telegram messages, written in the same transaction as the change
+    # that caused them and delivered by the outbox dispatcher
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            created_at TEXT,
+            last_error TEXT,
+            digest TEXT
+        )
+    """)
+
+    # Databases created before migrations existed lack some columns
+    for table, columns in LEGACY_COLUMNS.items():
+        await _add_missing_columns(db, table, columns)
+
+    # Index builds on a big legacy database would hold up startup: build them after
+    # startup, one index per transaction. An empty database gets them right away.
+    async with db.execute("""
+        SELECT EXISTS (SELECT 1 FROM bookings) OR EXISTS (SELECT 1 FROM orders)
+    """) as cursor:
+        has_data = (await cursor.fetchone())[0]
+    if has_data:
+        await _schedule_backfill(db, 'indexes')
+    else:
+        for statement in INDEXES:
+            await db.execute(statement)
+
+    # Legacy orders only have their items as JSON
+    async with db.execute("""
+        SELECT 1 FROM orders WHERE NOT EXISTS (SELECT 1 FROM meta WHERE key = 'order_items_backfilled') LIMIT 1
+    """) as cursor:
+        if await cursor.fetchone():
+            await _schedule_backfill(db, 'order_items')
+
+async def _migration_2_shared_state(db):
+    # aiogram FSM state survives restarts and is shared by worker processes
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT DEFAULT '{}'
+        )
+    """)
+    # Catalog write counters, so other processes know when to drop their cached copy
+    await db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog:menu', 0)")
+    await db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog:rooms', 0)")
+
+async def _migration_3_daily_stats(db):
+    # Reporting aggregates, see "Daily stats". Built here in one set-based pass: a
+    # chunked backfill would race with the incremental updates of concurrent writes.
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            room_number INTEGER NOT NULL,
+            nights INTEGER DEFAULT 0,
+            room_revenue REAL DEFAULT 0,
+            extras REAL DEFAULT 0,
+            payments REAL DEFAULT 0,
+            PRIMARY KEY (day, room_number)
+        ) WITHOUT ROWID
+    """)
+    await _build_daily_stats(db)
+
+async def _migration_4_guest_search(db):
+    # Filled in the same transaction: the triggers are live from here on, and a
+    # contentless index must never be asked to delete an entry it does not have
+    await _create_guest_search(db)
+    await _fill_guest_search(db)
+
+MIGRATIONS = [
+    _migration_1_baseline,
+    _migration_2_shared_state,
+    _migration_3_daily_stats,
+    _migration_4_guest_search,
+]
+
+async def _get_schema_version(db):
+    async with db.execute("PRAGMA user_version") as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+async def init_db():
+    async with _connect() as db:
+        version = await _get_schema_version(db)
+    if version >= len(MIGRATIONS):
+        return
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        async with _transaction() as db:
+            # Another process may have got here first
+            if await _get_schema_version(db) >= number:
+                continue
+            logging.info(f"Applying migration {number}: {migration.__name__}")
+            await migration(db)
+            await db.execute(f"PRAGMA user_version = {number}")
+
+# --- Backfills ---
+# Registered in meta as 'backfill:<name>' = cursor. Each chunk runs in its own short
+# transaction and stores the new cursor, so foreground writes interleave and an
+# interrupted backfill resumes where it stopped. The chunk function returns the
+# next cursor, or None when done.
+BACKFILL_CHUNK_SIZE = 500
+BACKFILL_PAUSE = 0.01
+
+async def _schedule_backfill(db, name):
+    await db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)", (f"backfill:{name}",))
+
+async def run_backfills():
+    async with _connect() as db:
+        async with db.execute("SELECT key FROM meta WHERE key LIKE 'backfill:%' ORDER BY key") as cursor:
+            names = [row[0].split(':', 1)[1] for row in await cursor.fetchall()]
+
+    for name in names:
+        key = f"backfill:{name}"
+        chunk = BACKFILLS[name]
+        logging.info(f"Running backfill {name}")
+        while True:
+            async with _transaction() as db:
+                async with db.execute("SELECT value FROM meta WHERE key = ?", (key,)) as cursor:
+                    row = await cursor.fetchone()
+                if row is None:
+                    break
+                position = await chunk(db, row[0], BACKFILL_CHUNK_SIZE)
+                if position is None:
+                    await db.execute("DELETE FROM meta WHERE key = ?", (key,))
+                    break
+                await db.execute("UPDATE meta SET value = ? WHERE key = ?", (position, key))
+            await asyncio.sleep(BACKFILL_PAUSE)
+        logging.info(f"Backfill {name} done")
+
+# --- Revisions ---
+# Every booking, order and cleaning mutation takes the next revision inside its
+# own transaction and stamps it on the affected bookings, so pollers can ask
+# for "everything after rev N".
+async def _next_revision(db):
+    await db.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+    async with db.execute("SELECT value FROM meta WHERE key = 'revision'") as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+async def get_revision():
+    async with _connect() as db:
+        async with db.execute("SELECT value FROM meta WHERE key = 'revision'") as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+# A feed with more changes than this (bulk import, stale client) is not listed;
+# it returns {"rev": N, "resync": true} and the client reloads what it shows
+MAX_FEED_CHANGES = 500
+
+async def get_booking_changes(since, limit=MAX_FEED_CHANGES):
+    async with _connect() as db:
+        # Read the revision first: rows committed meanwhile are sent again next time, never skipped
+        async with db.execute("SELECT value FROM meta WHERE key = 'revision'") as cursor:
+            row = await cursor.fetchone()
+            rev = row[0] if row else 0
+        async with db.execute("SELECT * FROM bookings WHERE rev > ? ORDER BY rev LIMIT ?", (since, limit + 1)) as cursor:
+            changed = [dict(row) for row in await cursor.fetchall()]
+        if len(changed) > limit:
+            return {"rev": rev, "resync": True}
+        async with db.execute("""
+            SELECT booking_id FROM booking_tombstones WHERE rev > ? LIMIT ?
+        """, (since, limit + 1 - len(changed))) as cursor:
+            deleted = [row[0] for row in await cursor.fetchall()]
+        if len(changed) + len(deleted) > limit:
+            return {"rev": rev, "resync": True}
+        return {"rev": rev, "changed": changed, "deleted": deleted}
+
+# --- Lookup cache ---
+# The bot resolves the same guest (user by id or phone, their active booking) several
+# times per update and again on the guest's next message. Results are memoized for
+# the current update or HTTP request (lookup_scope) and kept in a small TTL LRU.
+# Writes drop exactly the entries they can change once they commit; reads inside a
+# write transaction always go to the database.
+LOOKUP_CACHE_SIZE = 4096
+LOOKUP_CACHE_TTL = 60
+
+_MISS = object()
+
+class LookupCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # Bumped by every invalidation, so a load that raced with a write is not stored
+        self.generation = 0
+        self._entries = OrderedDict()
+        # Last seen shared counters, see sync_lookups
+        self.shared = None
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISS
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return _MISS
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, keys=(), booking_ids=()):
+        self.generation += 1
+        for key in keys:
+            self._entries.pop(key, None)
+        if booking_ids:
+            for key, (_, value) in list(self._entries.items()):
+                if key[0] == 'active' and value[1] and value[1]['id'] in booking_ids:
+                    del self._entries[key]
+        _drop_memo()
+
+    def clear(self, kind=None):
+        self.generation += 1
+        for key in [key for key in self._entries if kind is None or key[0] == kind]:
+            del self._entries[key]
+        _drop_memo()
+
+_lookups = LookupCache(LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL)
+_lookup_memo = ContextVar('lookup_memo', default=None)
+
+def _drop_memo():
+    memo = _lookup_memo.get()
+    if memo:
+        memo.clear()
+
+@contextmanager
+def lookup_scope():
+    # One bot update or HTTP request: repeated lookups inside it are answered from memory
+    token = _lookup_memo.set({})
+    try:
+        yield
+    finally:
+        _lookup_memo.reset(token)
+
+async def _cached_lookup(key, load):
+    if _active_tx() is not None:
+        return await load()
+    memo = _lookup_memo.get()
+    if memo is not None and key in memo:
+        return memo[key]
+    value = _lookups.get(key)
+    if value is _MISS:
+        generation = _lookups.generation
+        value = await load()
+        if generation == _lookups.generation:
+            _lookups.put(key, value)
+    if memo is not None:
+        memo[key] = value
+    return value
+
+def _user_changed(user_id, phone=None):
+    keys = [('user', user_id)]
+    if phone:
+        keys.append(('phone', phone))
+    on_commit(lambda: _lookups.invalidate(keys))
+
+def _bookings_changed(user_ids=(), booking_ids=()):
+    # user_ids whose active booking may have changed; booking_ids also reach
+    # entries cached for a previous owner of the booking
+    keys = [('active', user_id) for user_id in user_ids if user_id is not None]
+    on_commit(lambda: _lookups.invalidate(keys, set(booking_ids)))
+
+async def _users_written(db):
+    # Lets other worker processes know their cached users are stale
+    await db.execute("""
+        INSERT INTO meta (key, value) VALUES ('users', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    """)
+
+async def sync_lookups():
+    # Picks up writes made by other processes. Any booking write there (the
+    # revision) drops the cached active bookings, a user write all cached users.
+    async with _connect() as db:
+        async with db.execute("SELECT key, value FROM meta WHERE key IN ('revision', 'users')") as cursor:
+            shared = {key: value for key, value in await cursor.fetchall()}
+    previous, _lookups.shared = _lookups.shared, shared
+    if previous is None:
+        return
+    if previous.get('revision') != shared.get('revision'):
+        _lookups.clear('active')
+    if previous.get('users') != shared.get('users'):
+        _lookups.clear('user')
+        _lookups.clear('phone')
+
 # --- User ---
 async def add_user(user_id, username, current_room):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         # Update existing or insert new.
         # Note: This overwrites phone if it was NULL, but if we want to keep existing phone?
         # We should probably check if user exists.
@@ -122,56 +787,208 @@ async def add_user(user_id, username, current_room):
                 INSERT INTO users (user_id, username, current_room)
                 VALUES (?, ?, ?)
             """, (user_id, username, current_room))
-        await db.commit()
+        await _users_written(db)
+        _user_changed(user_id)
 
 async def update_user_phone(user_id, phone):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         try:
             await db.execute("UPDATE users SET phone = ? WHERE user_id = ?", (phone, user_id))
-            await db.commit()
-            return True
         except aiosqlite.IntegrityError:
             return False
+        await _users_written(db)
+        # A cached lookup of the old phone still points here; get_user_by_phone rechecks it
+        _user_changed(user_id, phone)
+        return True
 
-async def get_user(user_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+async def _load_user(column, value):
+    async with _connect() as db:
+        async with db.execute(f"SELECT * FROM users WHERE {column} = ?", (value,)) as cursor:
             row = await cursor.fetchone()
-            if row:
-                return dict(row)
-            return None
+            return dict(row) if row else None
+
+async def get_user(user_id):
+    user = await _cached_lookup(('user', user_id), lambda: _load_user('user_id', user_id))
+    return dict(user) if user else None
 
 async def get_user_by_phone(phone):
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM users WHERE phone = ?", (phone,)) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return dict(row)
-            return None
+    # Cached as phone -> user_id, so every copy of the user row is under ('user', id)
+    async def load():
+        user = await _load_user('phone', phone)
+        return user['user_id'] if user else None
+
+    user_id = await _cached_lookup(('phone', phone), load)
+    if user_id is None:
+        return None
+    user = await get_user(user_id)
+    if user and user['phone'] == phone:
+        return user
+    # The phone moved to someone else since it was cached
+    return await _load_user('phone', phone)
 
 # --- Orders ---
+def _order_item_rows(order_id, items, created_at):
+    # Carts arrive as {"<menu id>": {name, qty, price, ...}} from the WebApps
+    entries = items.items() if isinstance(items, dict) else enumerate(items)
+    rows = []
+    for key, item in entries:
+        menu_item_id = item.get('id', key)
+        try:
+            menu_item_id = int(menu_item_id)
+        except (TypeError, ValueError):
+            menu_item_id = None
+        rows.append((order_id, menu_item_id, item.get('name'), item.get('qty', 1), item.get('price', 0), created_at))
+    return rows
+
+async def _insert_order_items(db, order_id, items, created_at):
+    await db.executemany("""
+        INSERT INTO order_items (order_id, menu_item_id, name, qty, unit_price, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, _order_item_rows(order_id, items, created_at))
+
 async def save_order(user_id, items, total_price, booking_id=None, phone=None):
     created_at = datetime.now().isoformat()
     items_json = json.dumps(items)
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         cursor = await db.execute("""
             INSERT INTO orders (user_id, items, total_price, created_at, booking_id, phone)
             VALUES (?, ?, ?, ?, ?, ?)
         """, (user_id, items_json, total_price, created_at, booking_id, phone))
-        await db.commit()
-        return cursor.lastrowid
+        await _insert_order_items(db, cursor.lastrowid, items, created_at)
+        await _add_order_stats(db, "o.id = ?", (cursor.lastrowid,))
+        if booking_id:
+            rev = await _next_revision(db)
+            async with db.execute("UPDATE bookings SET rev = ? WHERE id = ? RETURNING user_id", (rev, booking_id)) as updated:
+                _bookings_changed([row[0] for row in await updated.fetchall()], [booking_id])
+    return cursor.lastrowid
 
 async def get_orders_by_booking(booking_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM orders WHERE booking_id = ?", (booking_id,)) as cursor:
+    async with _connect() as db:
+        async with db.execute("""
+            SELECT o.*, oi.menu_item_id, oi.name AS item_name, oi.qty, oi.unit_price
+            FROM orders o
+            LEFT JOIN order_items oi ON oi.order_id = o.id
+            WHERE o.booking_id = ?
+            ORDER BY o.id, oi.id
+        """, (booking_id,)) as cursor:
             rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+
+    orders = {}
+    for row in rows:
+        order = orders.get(row['id'])
+        if order is None:
+            order = {key: row[key] for key in row.keys() if key not in ('menu_item_id', 'item_name', 'qty', 'unit_price')}
+            order['items'] = []
+            orders[row['id']] = order
+        if row['item_name'] is not None or row['menu_item_id'] is not None:
+            order['items'].append({
+                "menu_item_id": row['menu_item_id'],
+                "name": row['item_name'],
+                "qty": row['qty'],
+                "price": row['unit_price'],
+            })
+    return list(orders.values())
+
+async def _backfill_order_items(db, last_id, chunk_size):
+    # Copies the legacy orders.items JSON into order_items
+    async with db.execute("""
+        SELECT o.id, o.items, o.created_at FROM orders o
+        WHERE o.id > ? AND NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = o.id)
+        ORDER BY o.id LIMIT ?
+    """, (last_id, chunk_size)) as cursor:
+        chunk = await cursor.fetchall()
+    if not chunk:
+        await db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('order_items_backfilled', 1)")
+        return None
+
+    rows = []
+    for order_id, items_json, created_at in chunk:
+        try:
+            rows += _order_item_rows(order_id, json.loads(items_json or '{}'), created_at)
+        except (ValueError, AttributeError):
+            logging.warning(f"Skipping unreadable items of order {order_id}")
+    await db.executemany("""
+        INSERT INTO order_items (order_id, menu_item_id, name, qty, unit_price, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+    return chunk[-1][0]
+
+async def place_order(user_id, items, total_price, room_number=None):
+    # Resolve booking, user and phone, store the order and bump the booking's
+    # extras in one transaction with a single commit.
+    created_at = datetime.now().isoformat()
+    items_json = json.dumps(items)
+    async with _transaction() as db:
+        # Prefer the user's own booking (survives room moves), then the room the WebApp reports
+        booking = await _fetch_active_booking(db, ACTIVE_BOOKING_BY_USER, user_id)
+        if not booking and room_number is not None:
+            booking = await _fetch_active_booking(db, ACTIVE_BOOKING_BY_ROOM, room_number)
+        if booking:
+            room_number = booking['room_number']
+        booking_id = booking['id'] if booking else None
+
+        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            user = dict(row) if row else None
+        phone = user.get('phone') if user else None
+
+        cursor = await db.execute("""
+            INSERT INTO orders (user_id, items, total_price, created_at, booking_id, phone)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, items_json, total_price, created_at, booking_id, phone))
+        order_id = cursor.lastrowid
+        await _insert_order_items(db, order_id, items, created_at)
+        await _add_order_stats(db, "o.id = ?", (order_id,))
+
+        if booking_id:
+            await _add_booking_extras(db, booking_id, total_price)
+
+    return {
+        "order_id": order_id,
+        "booking_id": booking_id,
+        "room_number": room_number,
+        "user": user,
+        "phone": phone,
+    }
 
 # --- Bookings ---
-async def add_booking(room_number, guest_name, check_in, check_out, cost_per_night, phone=None, paid_amount=0):
+class BookingConflictError(Exception):
+    def __init__(self, conflicts):
+        super().__init__(f"Room is already booked for these dates ({len(conflicts)} overlapping)")
+        self.conflicts = conflicts
+
+# Stays are half-open [check_in, check_out): a same-day turnover is not a conflict
+def _check_stay(check_in, check_out):
+    # An empty or inverted stay matches no overlap query, so it would bypass the check
+    if not check_in or not check_out or check_out <= check_in:
+        raise ValueError("check_out must be after check_in")
+
+async def _find_conflicts(db, room_number, check_in, check_out, exclude_id=None):
+    async with db.execute("""
+        SELECT id, room_number, guest_name, check_in, check_out FROM bookings
+        WHERE room_number = ? AND check_out > ? AND check_in < ? AND id != ?
+        ORDER BY check_in
+    """, (room_number, check_in, check_out, exclude_id or 0)) as cursor:
+        return [dict(row) for row in await cursor.fetchall()]
+
+async def find_booking_conflicts(room_number, check_in, check_out, exclude_id=None):
+    async with _connect() as db:
+        return await _find_conflicts(db, room_number, check_in, check_out, exclude_id)
+
+async def get_available_rooms(date_from, date_to):
+    async with _connect() as db:
+        async with db.execute("""
+            SELECT * FROM rooms r
+            WHERE NOT EXISTS (
+                SELECT 1 FROM bookings b
+                WHERE b.room_number = r.number AND b.check_out > ? AND b.check_in < ?
+            )
+            ORDER BY r.number
+        """, (date_from, date_to)) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+async def add_booking(room_number, guest_name, check_in, check_out, cost_per_night, phone=None, paid_amount=0, allow_overlap=False):
+    _check_stay(check_in, check_out)
     # Try to resolve user_id from phone
     user_id = None
     if phone:
@@ -179,13 +996,20 @@ async def add_booking(room_number, guest_name, check_in, check_out, cost_per_nig
         if u:
             user_id = u['user_id']
 
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
+        # Checked inside the write transaction, so two requests cannot both take the room
+        if not allow_overlap:
+            conflicts = await _find_conflicts(db, room_number, check_in, check_out)
+            if conflicts:
+                raise BookingConflictError(conflicts)
+
+        rev = await _next_revision(db)
         cursor = await db.execute("""
-            INSERT INTO bookings (room_number, guest_name, check_in, check_out, cost_per_night, phone, user_id, paid_amount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (room_number, guest_name, check_in, check_out, cost_per_night, phone, user_id, paid_amount))
+            INSERT INTO bookings (room_number, guest_name, check_in, check_out, cost_per_night, phone, user_id, paid_amount, rev)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (room_number, guest_name, check_in, check_out, cost_per_night, phone, user_id, paid_amount, rev))
         new_booking_id = cursor.lastrowid
-        await db.commit()
+        await _add_stay_stats(db, "id = ?", (new_booking_id,))
 
         # Link orphan orders by phone if available
         if phone:
@@ -202,180 +1026,923 @@ async def add_booking(room_number, guest_name, check_in, check_out, cost_per_nig
                 orphaned_orders = await order_cursor.fetchall()
 
             if orphaned_orders:
+                # Their extras move from NO_ROOM to this booking's room
+                order_ids = [order_id for order_id, _ in orphaned_orders]
+                relinked = f"o.id IN ({', '.join('?' * len(order_ids))})"
+                await _add_order_stats(db, relinked, order_ids, -1)
                 extras_to_add = 0
                 for order_id, price in orphaned_orders:
                     extras_to_add += price
                     await db.execute("UPDATE orders SET booking_id = ? WHERE id = ?", (new_booking_id, order_id))
+                await _add_order_stats(db, relinked, order_ids)
 
                 if extras_to_add > 0:
                      await db.execute("UPDATE bookings SET extras_total = extras_total + ? WHERE id = ?", (extras_to_add, new_booking_id))
-                await db.commit()
 
-        return new_booking_id
+        _bookings_changed([user_id])
+
+    # Booking and its relinked orders become visible together
+    return new_booking_id
 
 async def link_bookings_to_user(phone, user_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            UPDATE bookings SET user_id = ? WHERE phone = ?
-        """, (user_id, phone))
-        await db.commit()
+    async with _transaction() as db:
+        rev = await _next_revision(db)
+        async with db.execute("""
+            UPDATE bookings SET user_id = ?, rev = ? WHERE phone = ? RETURNING id
+        """, (user_id, rev, phone)) as cursor:
+            booking_ids = [row[0] for row in await cursor.fetchall()]
+        _bookings_changed([user_id], booking_ids)
 
-async def update_booking_extras(room_number, amount, booking_id=None):
+ACTIVE_BOOKING_BY_ROOM = """
+    SELECT * FROM bookings
+    WHERE room_number = ? AND check_in <= ? AND check_out > ?
+    ORDER BY check_in DESC LIMIT 1
+"""
+ACTIVE_BOOKING_BY_USER = """
+    SELECT * FROM bookings
+    WHERE user_id = ? AND check_in <= ? AND check_out > ?
+    ORDER BY check_in DESC LIMIT 1
+"""
+
+async def _fetch_active_booking(db, query, key):
     today = datetime.now().strftime("%Y-%m-%d")
-    async with aiosqlite.connect(DB_NAME) as db:
-        if booking_id:
-            # Direct update if ID is known
-            async with db.execute("SELECT extras_total FROM bookings WHERE id = ?", (booking_id,)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    current_extras = row[0] or 0
-                    new_extras = current_extras + amount
-                    await db.execute("UPDATE bookings SET extras_total = ? WHERE id = ?", (new_extras, booking_id))
-                    await db.commit()
-                    return booking_id
-        else:
+    async with db.execute(query, (key, today, today)) as cursor:
+        row = await cursor.fetchone()
+        return dict(row) if row else None
+
+async def _add_booking_extras(db, booking_id, amount):
+    # Increment in SQL: concurrent orders for the same booking must not overwrite each other
+    rev = await _next_revision(db)
+    async with db.execute("""
+        UPDATE bookings SET extras_total = COALESCE(extras_total, 0) + ?, rev = ? WHERE id = ? RETURNING user_id
+    """, (amount, rev, booking_id)) as cursor:
+        _bookings_changed([row[0] for row in await cursor.fetchall()], [booking_id])
+
+async def update_booking_extras(room_number, amount, booking_id=None):
+    async with _transaction() as db:
+        if not booking_id:
             # Find active booking for this room
-            async with db.execute("""
-                SELECT id, extras_total FROM bookings
-                WHERE room_number = ? AND check_in <= ? AND check_out > ?
-                ORDER BY check_in DESC LIMIT 1
-            """, (room_number, today, today)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    booking_id = row[0]
-                    current_extras = row[1] or 0
-                    new_extras = current_extras + amount
-                    await db.execute("UPDATE bookings SET extras_total = ? WHERE id = ?", (new_extras, booking_id))
-                    await db.commit()
-                    return booking_id
-    return None
+            booking = await _fetch_active_booking(db, ACTIVE_BOOKING_BY_ROOM, room_number)
+            if not booking:
+                return None
+            booking_id = booking['id']
+        await _add_booking_extras(db, booking_id, amount)
+        return booking_id
 
 async def get_active_booking_by_room(room_number):
-    today = datetime.now().strftime("%Y-%m-%d")
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("""
-            SELECT * FROM bookings
-            WHERE room_number = ? AND check_in <= ? AND check_out > ?
-            ORDER BY check_in DESC LIMIT 1
-        """, (room_number, today, today)) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return dict(row)
-    return None
+    async with _connect() as db:
+        return await _fetch_active_booking(db, ACTIVE_BOOKING_BY_ROOM, room_number)
 
 async def get_active_booking_by_user(user_id):
+    # Cached with the day it was looked up for: a stay ends at midnight, not at a write
+    async def load():
+        async with _connect() as db:
+            return (today, await _fetch_active_booking(db, ACTIVE_BOOKING_BY_USER, user_id))
+
     today = datetime.now().strftime("%Y-%m-%d")
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("""
-            SELECT * FROM bookings
-            WHERE user_id = ? AND check_in <= ? AND check_out > ?
-            ORDER BY check_in DESC LIMIT 1
-        """, (user_id, today, today)) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return dict(row)
-    return None
+    key = ('active', user_id)
+    day, booking = await _cached_lookup(key, load)
+    if day != today:
+        _lookups.invalidate([key])
+        day, booking = await _cached_lookup(key, load)
+    return dict(booking) if booking else None
+
+async def get_bookings(date_from=None, date_to=None, room_number=None, limit=None, offset=0):
+    # Dates are inclusive: a stay shows up on both its check-in and check-out day
+    conditions = []
+    params = []
+    if room_number is not None:
+        conditions.append("room_number = ?")
+        params.append(room_number)
+    if date_from:
+        conditions.append("check_out >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("check_in <= ?")
+        params.append(date_to)
 
-async def get_bookings():
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM bookings") as cursor:
+    query = "SELECT * FROM bookings"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY check_in, id"
+    if limit is not None:
+        query += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+
+    async with _connect() as db:
+        async with db.execute(query, params) as cursor:
             rows = await cursor.fetchall()
             return [dict(row) for row in rows]
 
 async def get_booking(booking_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _connect() as db:
         async with db.execute("SELECT * FROM bookings WHERE id = ?", (booking_id,)) as cursor:
             row = await cursor.fetchone()
             if row:
                 return dict(row)
             return None
 
-async def update_booking(booking_id, room_number, guest_name, check_in, check_out, cost_per_night, phone, paid_amount):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
+async def update_booking(booking_id, room_number, guest_name, check_in, check_out, cost_per_night, phone, paid_amount, allow_overlap=False):
+    _check_stay(check_in, check_out)
+    async with _transaction() as db:
+        if not allow_overlap:
+            conflicts = await _find_conflicts(db, room_number, check_in, check_out, exclude_id=booking_id)
+            if conflicts:
+                raise BookingConflictError(conflicts)
+
+        await _add_booking_stats(db, booking_id, -1)
+        rev = await _next_revision(db)
+        async with db.execute("""
             UPDATE bookings
-            SET room_number = ?, guest_name = ?, check_in = ?, check_out = ?, cost_per_night = ?, phone = ?, paid_amount = ?
+            SET room_number = ?, guest_name = ?, check_in = ?, check_out = ?, cost_per_night = ?, phone = ?, paid_amount = ?, rev = ?
             WHERE id = ?
-        """, (room_number, guest_name, check_in, check_out, cost_per_night, phone, paid_amount, booking_id))
-        await db.commit()
+            RETURNING user_id
+        """, (room_number, guest_name, check_in, check_out, cost_per_night, phone, paid_amount, rev, booking_id)) as cursor:
+            _bookings_changed([row[0] for row in await cursor.fetchall()], [booking_id])
+        await _add_booking_stats(db, booking_id)
 
 async def delete_booking(booking_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM bookings WHERE id = ?", (booking_id,))
-        await db.commit()
+    async with _transaction() as db:
+        await _add_booking_stats(db, booking_id, -1)
+        rev = await _next_revision(db)
+        async with db.execute("DELETE FROM bookings WHERE id = ? RETURNING user_id", (booking_id,)) as cursor:
+            _bookings_changed([row[0] for row in await cursor.fetchall()], [booking_id])
+        # Its orders stay, now without a booking
+        await _add_order_stats(db, "o.booking_id = ?", (booking_id,))
+        await db.execute("INSERT OR REPLACE INTO booking_tombstones (booking_id, rev) VALUES (?, ?)", (booking_id, rev))
 
 async def toggle_booking_cleaning_status(booking_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         async with db.execute("SELECT is_cleaned FROM bookings WHERE id = ?", (booking_id,)) as cursor:
             row = await cursor.fetchone()
             if row:
                 current_status = row[0]
                 new_status = 0 if current_status else 1
-                await db.execute("UPDATE bookings SET is_cleaned = ? WHERE id = ?", (new_status, booking_id))
-                await db.commit()
+                rev = await _next_revision(db)
+                async with db.execute("""
+                    UPDATE bookings SET is_cleaned = ?, rev = ? WHERE id = ? RETURNING user_id
+                """, (new_status, rev, booking_id)) as updated:
+                    _bookings_changed([row[0] for row in await updated.fetchall()], [booking_id])
                 return new_status
     return None
 
+# --- Bulk import / export ---
+EXPORT_TABLES = ('bookings', 'orders', 'order_items', 'reviews')
+IMPORT_BOOKING_COLUMNS = ('room_number', 'guest_name', 'check_in', 'check_out', 'cost_per_night',
+                          'phone', 'paid_amount', 'extras_total', 'status', 'is_cleaned')
+
+async def iter_table(table, chunk_size=500):
+    # Keyset pages by id: no row lists in memory and no read connection held between chunks
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Unknown table {table}")
+    last_id = 0
+    while True:
+        async with _connect() as db:
+            async with db.execute(f"SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (last_id, chunk_size)) as cursor:
+                columns = [column[0] for column in cursor.description]
+                chunk = await cursor.fetchall()
+        if not chunk:
+            return
+        yield columns, chunk
+        last_id = chunk[-1]['id']
+
+async def _find_import_conflicts(db, rows):
+    # Same rule as add_booking, set-based: one indexed join against stored bookings,
+    # then earlier rows of the batch. Returns {row index: conflicts}.
+    await db.execute("DROP TABLE IF EXISTS temp.import_stays")
+    await db.execute("CREATE TEMP TABLE import_stays (idx INTEGER, room_number INTEGER, check_in TEXT, check_out TEXT)")
+    await db.executemany("INSERT INTO import_stays VALUES (?, ?, ?, ?)",
+                         [(i, row[0], row[2], row[3]) for i, row in enumerate(rows)])
+    conflicts = {}
+    async with db.execute("""
+        SELECT s.idx, b.id, b.room_number, b.guest_name, b.check_in, b.check_out
+        FROM import_stays s
+        JOIN bookings b ON b.room_number = s.room_number AND b.check_out > s.check_in AND b.check_in < s.check_out
+        ORDER BY s.idx, b.check_in
+    """) as cursor:
+        for row in await cursor.fetchall():
+            conflicts.setdefault(row[0], []).append({key: row[key] for key in row.keys() if key != 'idx'})
+    await db.execute("DROP TABLE import_stays")
+
+    accepted = {}
+    for i, (room_number, guest_name, check_in, check_out, *_) in enumerate(rows):
+        if i in conflicts:
+            continue
+        overlapping = [stay for stay in accepted.get(room_number, [])
+                       if stay['check_out'] > check_in and stay['check_in'] < check_out]
+        if overlapping:
+            conflicts[i] = overlapping
+            continue
+        accepted.setdefault(room_number, []).append({
+            "id": None, "room_number": room_number, "guest_name": guest_name,
+            "check_in": check_in, "check_out": check_out
+        })
+    return conflicts
+
+async def import_bookings_batch(rows, allow_overlap=False):
+    # rows are tuples in IMPORT_BOOKING_COLUMNS order; one transaction and one revision per batch.
+    # Rows that overlap a booking are left out unless allow_overlap. Returns the id of
+    # the first inserted row (None if none) and {row index: conflicts} of the left out.
+    async with _transaction() as db:
+        conflicts = {} if allow_overlap else await _find_import_conflicts(db, rows)
+        rows = [row for i, row in enumerate(rows) if i not in conflicts]
+        if not rows:
+            return None, conflicts
+        rev = await _next_revision(db)
+        await db.executemany(f"""
+            INSERT INTO bookings ({', '.join(IMPORT_BOOKING_COLUMNS)}, rev)
+            VALUES ({', '.join('?' * len(IMPORT_BOOKING_COLUMNS))}, ?)
+        """, [(*row, rev) for row in rows])
+        async with db.execute("SELECT last_insert_rowid()") as cursor:
+            last_id = (await cursor.fetchone())[0]
+        await _add_stay_stats(db, "id BETWEEN ? AND ?", (last_id - len(rows) + 1, last_id))
+    return last_id - len(rows) + 1, conflicts
+
+async def finish_bookings_import(first_id):
+    # Set-based equivalent of what add_booking does per row: resolve users by phone,
+    # then hand orphaned orders to the first imported booking with the same phone.
+    async with _transaction() as db:
+        rev = await _next_revision(db)
+        await db.execute("""
+            UPDATE bookings
+            SET user_id = (SELECT u.user_id FROM users u WHERE u.phone = bookings.phone), rev = ?
+            WHERE id >= ? AND user_id IS NULL AND phone IS NOT NULL
+              AND EXISTS (SELECT 1 FROM users u WHERE u.phone = bookings.phone)
+        """, (rev, first_id))
+        await db.execute("DROP TABLE IF EXISTS temp.relink")
+        await db.execute("""
+            CREATE TEMP TABLE relink AS
+            SELECT o.id AS order_id, o.total_price AS total_price,
+                   (SELECT MIN(b.id) FROM bookings b WHERE b.phone = o.phone AND b.id >= ?) AS booking_id
+            FROM orders o
+            WHERE o.status = 'new' AND o.phone IS NOT NULL
+              AND (o.booking_id IS NULL OR o.booking_id NOT IN (SELECT id FROM bookings))
+        """, (first_id,))
+        await db.execute("DELETE FROM relink WHERE booking_id IS NULL")
+        relinked_orders = "o.id IN (SELECT order_id FROM relink)"
+        await _add_order_stats(db, relinked_orders, (), -1)
+        await db.execute("""
+            UPDATE orders SET booking_id = (SELECT r.booking_id FROM relink r WHERE r.order_id = orders.id)
+            WHERE id IN (SELECT order_id FROM relink)
+        """)
+        await _add_order_stats(db, relinked_orders, ())
+        await db.execute("""
+            UPDATE bookings
+            SET extras_total = COALESCE(extras_total, 0) + (SELECT SUM(r.total_price) FROM relink r WHERE r.booking_id = bookings.id),
+                rev = ?
+            WHERE id IN (SELECT booking_id FROM relink)
+        """, (rev,))
+        async with db.execute("SELECT COUNT(*) FROM relink") as cursor:
+            relinked = (await cursor.fetchone())[0]
+        await db.execute("DROP TABLE relink")
+        # Set-based: imported rows only gain a user here, so drop every cached active booking
+        on_commit(lambda: _lookups.clear('active'))
+    return relinked
+
+# --- Daily stats ---
+# daily_stats holds per day and room: occupied nights and their room revenue (a stay
+# counts on every night from check_in to the night before check_out), payments (on
+# the check-in day) and extras (orders on the day they were placed, under their
+# booking's room or NO_ROOM). It is always the sum over the current rows: every
+# write that changes those rows subtracts their old contribution and adds the new one
+# in the same transaction, so reports never scan bookings or orders.
+NO_ROOM = 0
+# Stays longer than this are typos (a check-out years away) and are not counted
+STATS_MAX_NIGHTS = 366
+
+STATS_UPSERT = """
+    ON CONFLICT(day, room_number) DO UPDATE SET
+        nights = nights + excluded.nights,
+        room_revenue = room_revenue + excluded.room_revenue,
+        extras = extras + excluded.extras,
+        payments = payments + excluded.payments
+"""
+
+async def _add_stay_stats(db, where, params, sign=1):
+    # where selects bookings; sign -1 takes their contribution back out
+    await db.execute(f"""
+        WITH RECURSIVE nights(day, room_number, cost, check_out) AS (
+            SELECT check_in, room_number, COALESCE(cost_per_night, 0), check_out FROM bookings
+            WHERE ({where}) AND check_in < check_out
+              AND julianday(check_out) - julianday(check_in) <= {STATS_MAX_NIGHTS}
+            UNION ALL
+            SELECT date(day, '+1 day'), room_number, cost, check_out FROM nights
+            WHERE date(day, '+1 day') < check_out
+        )
+        INSERT INTO daily_stats (day, room_number, nights, room_revenue, extras, payments)
+        SELECT day, room_number, ? * COUNT(*), ? * SUM(cost), 0, 0 FROM nights
+        WHERE true GROUP BY day, room_number
+        {STATS_UPSERT}
+    """, (*params, sign, sign))
+    await db.execute(f"""
+        INSERT INTO daily_stats (day, room_number, nights, room_revenue, extras, payments)
+        SELECT check_in, room_number, 0, 0, 0, ? * SUM(paid_amount) FROM bookings
+        WHERE ({where}) AND paid_amount != 0 AND date(check_in) = check_in
+        GROUP BY check_in, room_number
+        {STATS_UPSERT}
+    """, (sign, *params))
+
+async def _add_order_stats(db, where, params, sign=1):
+    # where selects orders (alias o); an order without a live booking counts under NO_ROOM
+    await db.execute(f"""
+        INSERT INTO daily_stats (day, room_number, nights, room_revenue, extras, payments)
+        SELECT substr(o.created_at, 1, 10), COALESCE(b.room_number, {NO_ROOM}), 0, 0, ? * SUM(o.total_price), 0
+        FROM orders o LEFT JOIN bookings b ON b.id = o.booking_id
+        WHERE ({where}) AND o.created_at IS NOT NULL
+        GROUP BY 1, 2
+        {STATS_UPSERT}
+    """, (sign, *params))
+
+async def _add_booking_stats(db, booking_id, sign=1):
+    # The stay and the orders charged to it (they follow the booking's room)
+    await _add_stay_stats(db, "id = ?", (booking_id,), sign)
+    await _add_order_stats(db, "o.booking_id = ?", (booking_id,), sign)
+
+async def _build_daily_stats(db):
+    await db.execute("DELETE FROM daily_stats")
+    await _add_stay_stats(db, "1", ())
+    await _add_order_stats(db, "1", ())
+
+async def rebuild_daily_stats():
+    # Repair: recompute everything from bookings and orders
+    async with _transaction() as db:
+        await _build_daily_stats(db)
+        async with db.execute("SELECT COUNT(*), COALESCE(SUM(nights), 0) FROM daily_stats") as cursor:
+            rows, nights = await cursor.fetchone()
+    return {"rows": rows, "nights": nights}
+
+def _rates(nights, room_revenue, available):
+    return {
+        "occupancy": round(nights / available, 4) if available else None,
+        # Average daily rate: revenue per sold night; RevPAR: per available night
+        "adr": round(room_revenue / nights, 2) if nights else None,
+        "revpar": round(room_revenue / available, 2) if available else None,
+    }
+
+async def get_daily_report(date_from, date_to):
+    # Both dates inclusive; available nights are today's room count times the days
+    rooms = len(await get_rooms())
+    async with _connect() as db:
+        async with db.execute("""
+            SELECT day, SUM(nights), SUM(room_revenue), SUM(extras), SUM(payments) FROM daily_stats
+            WHERE day >= ? AND day <= ?
+            GROUP BY day
+        """, (date_from, date_to)) as cursor:
+            stats = {row[0]: row[1:] for row in await cursor.fetchall()}
+
+    days = []
+    totals = [0, 0, 0, 0]
+    day = date.fromisoformat(date_from)
+    last_day = date.fromisoformat(date_to)
+    while day <= last_day:
+        values = stats.get(day.isoformat(), (0, 0, 0, 0))
+        totals = [total + value for total, value in zip(totals, values)]
+        nights, room_revenue, extras, payments = values
+        days.append({
+            "date": day.isoformat(),
+            "nights": nights,
+            "room_revenue": round(room_revenue, 2),
+            "extras": round(extras, 2),
+            "payments": round(payments, 2),
+            **_rates(nights, room_revenue, rooms),
+        })
+        day += timedelta(days=1)
+
+    nights, room_revenue, extras, payments = totals
+    return {
+        "from": date_from,
+        "to": date_to,
+        "rooms": rooms,
+        "days": days,
+        "totals": {
+            "nights": nights,
+            "available_nights": rooms * len(days),
+            "room_revenue": round(room_revenue, 2),
+            "extras": round(extras, 2),
+            "payments": round(payments, 2),
+            **_rates(nights, room_revenue, rooms * len(days)),
+        },
+    }
+
+# --- Guest search ---
+# Contentless FTS5 indexes over bookings (booking_search, rowid = id) and users
+# (user_search, rowid = user_id), kept in sync by triggers. Each entry has the name,
+# the phone's digits (also without the country code, so +7 and 8 numbers both match
+# "912...") and the digits reversed, so "4567" finds ...4567 as a prefix of the
+# reversed number. The triggers are plain SQL, so edits made with other SQLite
+# tools keep the index right too.
+PHONE_PUNCTUATION = " +-()./"
+# Longest phone whose reversed digits are indexed in full
+PHONE_MAX_DIGITS = 15
+NATIONAL_DIGITS = 10
+SEARCH_PAGE_SIZE = 20
+# Ranking every match of a broad query ("+7") would cost ~1.5 us per match, so
+# results come in blocks: the newest SEARCH_BLOCK_SIZE matches of each index ranked
+# together by bm25, then the next block, and so on. A page only ranks the blocks it
+# reaches; paging continues through every match.
+SEARCH_BLOCK_SIZE = 500
+
+def _name_sql(value):
+    # unicode61 drops Latin diacritics only; fold ё by hand
+    return f"replace(replace({value}, 'ё', 'е'), 'Ё', 'Е')"
+
+def _digits_sql(value):
+    for char in PHONE_PUNCTUATION:
+        value = f"replace({value}, '{char}', '')"
+    return value
+
+def _reversed_digits_sql(value):
+    digits = _digits_sql(value)
+    return ' || '.join(f"substr({digits}, -{i}, 1)" for i in range(1, PHONE_MAX_DIGITS + 1))
+
+def _phone_tokens_sql(value):
+    digits = _digits_sql(value)
+    return f"{digits} || ' ' || substr({digits}, -{NATIONAL_DIGITS})"
+
+def _search_entry_sql(row, key, name):
+    # Column values of one index entry, from a row alias (NEW, OLD or a table)
+    return (f"{row}.{key}, {_name_sql(f'{row}.{name}')}, "
+            f"{_phone_tokens_sql(f'{row}.phone')}, {_reversed_digits_sql(f'{row}.phone')}")
+
+# (result type, table, index, key column, name column)
+SEARCH_SOURCES = (
+    ('booking', 'bookings', 'booking_search', 'id', 'guest_name'),
+    ('user', 'users', 'user_search', 'user_id', 'username'),
+)
+
+async def _create_guest_search(db):
+    columns = "rowid, name, phone, phone_rev"
+    for _, table, index, key, name in SEARCH_SOURCES:
+        await db.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5(
+                name, phone, phone_rev,
+                content='', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+        """)
+        new = _search_entry_sql('NEW', key, name)
+        old = _search_entry_sql('OLD', key, name)
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {index} ({columns}) VALUES ({new});
+            END
+        """)
+        # Contentless: a delete has to repeat the values that were indexed
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {index} ({index}, {columns}) VALUES ('delete', {old});
+            END
+        """)
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF {name}, phone ON {table}
+            WHEN OLD.{name} IS NOT NEW.{name} OR OLD.phone IS NOT NEW.phone BEGIN
+                INSERT INTO {index} ({index}, {columns}) VALUES ('delete', {old});
+                INSERT INTO {index} ({columns}) VALUES ({new});
+            END
+        """)
+
+async def _fill_guest_search(db):
+    for _, table, index, key, name in SEARCH_SOURCES:
+        await db.execute(f"INSERT INTO {index} ({index}) VALUES ('delete-all')")
+        await db.execute(f"""
+            INSERT INTO {index} (rowid, name, phone, phone_rev)
+            SELECT {_search_entry_sql(table, key, name)} FROM {table}
+        """)
+
+async def rebuild_guest_search():
+    # Repair: reindex every booking and user
+    async with _transaction() as db:
+        await _fill_guest_search(db)
+
+def _fts_string(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def _is_phone_word(word):
+    return any(char.isdigit() for char in word) and all(char.isdigit() or char in PHONE_PUNCTUATION for char in word)
+
+def _search_match(query):
+    # Words are name prefixes; a run of digits (spaces and phone punctuation allowed,
+    # anywhere in the query) matches the start or the end of a phone. Every word has to match.
+    query = query.replace('ё', 'е').replace('Ё', 'Е')
+    words = []
+    digits = ''
+    for word in query.split():
+        if _is_phone_word(word):
+            # "Иван +7 (900) 111-22-33": the phone's pieces become one digit run
+            digits += ''.join(char for char in word if char.isdigit())
+            continue
+        if digits:
+            words.append(digits)
+            digits = ''
+        words.append(word)
+    if digits:
+        words.append(digits)
+    terms = []
+    for word in words:
+        if not any(char.isalnum() for char in word):
+            continue
+        if word.isdigit():
+            terms.append(f"(phone : {_fts_string(word)}* OR phone_rev : {_fts_string(word[::-1])}*)")
+        else:
+            terms.append(f"name : {_fts_string(word)}*")
+    return ' AND '.join(terms) or None
+
+async def _search_block(db, match, block):
+    # Block `block` of every index, best first; FTS5 walks rowid DESC without sorting
+    hits = []
+    for kind, _, index, _, _ in SEARCH_SOURCES:
+        async with db.execute(f"""
+            SELECT rowid, rank FROM {index} WHERE {index} MATCH ?
+            ORDER BY rowid DESC LIMIT ? OFFSET ?
+        """, (match, SEARCH_BLOCK_SIZE, block * SEARCH_BLOCK_SIZE)) as cursor:
+            hits += [(rank, kind, rowid) for rowid, rank in await cursor.fetchall()]
+    hits.sort(key=lambda hit: (hit[0], -hit[2]))
+    return hits
+
+async def search_guests(query, limit=SEARCH_PAGE_SIZE, offset=0):
+    # Best matches first (bm25), newest first among equals. Returns (results, has_more).
+    match = _search_match(query)
+    if match is None:
+        return [], False
+    async with _connect() as db:
+        hits = []
+        skip = offset
+        block = 0
+        while len(hits) <= limit:
+            ranked = await _search_block(db, match, block)
+            if not ranked:
+                break
+            hits += ranked[skip:]
+            skip = max(0, skip - len(ranked))
+            block += 1
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+
+        rows = {}
+        for kind, table, _, key, _ in SEARCH_SOURCES:
+            ids = [rowid for _, hit_kind, rowid in hits if hit_kind == kind]
+            if not ids:
+                continue
+            async with db.execute(f"""
+                SELECT * FROM {table} WHERE {key} IN ({', '.join('?' * len(ids))})
+            """, ids) as cursor:
+                for row in await cursor.fetchall():
+                    rows[(kind, row[key])] = dict(row)
+
+    results = []
+    for rank, kind, rowid in hits:
+        row = rows.get((kind, rowid))
+        if row is not None:
+            results.append({"type": kind, "score": round(-rank, 4), **row})
+    return results, has_more
+
+# --- Occupancy grid ---
+# Room x day matrix for the PMS calendar. Cached per window and keyed on the
+# booking revision and rooms catalog version, so any booking write invalidates it.
+GRID_CACHE_SIZE = 32
+_grid_cache = OrderedDict()
+
+def _grid_cell(marks):
+    if marks is None:
+        return None
+    if 'ongoing' in marks:
+        return {"state": "ongoing", "booking": marks['ongoing']}
+    if 'departing' in marks and 'arriving' in marks:
+        return {"state": "split", "departing": marks['departing'], "arriving": marks['arriving'], "cleaned": marks['cleaned']}
+    if 'departing' in marks:
+        return {"state": "departing", "booking": marks['departing'], "cleaned": marks['cleaned']}
+    return {"state": "arriving", "booking": marks['arriving']}
+
+async def get_grid_json(start, days):
+    rev = await get_revision()
+    rooms = await get_rooms()
+    version = (rev, _catalogs['rooms'].version)
+    key = (start, days)
+    cached = _grid_cache.get(key)
+    if cached and cached[0] == version:
+        _grid_cache.move_to_end(key)
+        return cached[1], cached[2]
+
+    first_day = date.fromisoformat(start)
+    dates = [(first_day + timedelta(days=i)).isoformat() for i in range(days)]
+    async with _connect() as db:
+        async with db.execute("""
+            SELECT * FROM bookings WHERE check_out >= ? AND check_in <= ?
+        """, (dates[0], dates[-1])) as cursor:
+            bookings = [dict(row) for row in await cursor.fetchall()]
+
+    row_of = {room['number']: i for i, room in enumerate(rooms)}
+    marks = [[None] * days for _ in rooms]
+    for booking in bookings:
+        row = row_of.get(booking['room_number'])
+        if row is None:
+            continue
+        try:
+            check_in = date.fromisoformat(booking['check_in'])
+            check_out = date.fromisoformat(booking['check_out'])
+        except (TypeError, ValueError):
+            continue
+        # Only walk the days that fall inside the window
+        for i in range(max((check_in - first_day).days, 0), min((check_out - first_day).days, days - 1) + 1):
+            cell = marks[row][i]
+            if cell is None:
+                cell = marks[row][i] = {}
+            if dates[i] == booking['check_in']:
+                cell['arriving'] = booking['id']
+            elif dates[i] == booking['check_out']:
+                cell['departing'] = booking['id']
+                cell['cleaned'] = 1 if booking['is_cleaned'] else 0
+            else:
+                cell['ongoing'] = booking['id']
+
+    grid = {
+        "start": dates[0],
+        "days": days,
+        "rev": rev,
+        "dates": dates,
+        "rooms": [room['number'] for room in rooms],
+        "cells": [[_grid_cell(cell) for cell in row] for row in marks],
+        "bookings": {booking['id']: booking for booking in bookings},
+    }
+    body = json.dumps(grid).encode()
+    etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+
+    _grid_cache[key] = (version, body, etag)
+    _grid_cache.move_to_end(key)
+    while len(_grid_cache) > GRID_CACHE_SIZE:
+        _grid_cache.popitem(last=False)
+    return body, etag
+
+# --- Catalog cache ---
+# Menu and rooms change a few times a month but are read on every page open,
+# so they are served from memory together with their serialized JSON.
+class Catalog:
+    def __init__(self, query):
+        self.query = query
+        self.version = 0
+        # Last seen value of meta 'catalog:<name>', see sync_catalogs
+        self.shared_version = None
+        self.rows = None
+        self.body = None
+        self.etag = None
+
+    def invalidate(self):
+        self.version += 1
+        self.rows = None
+        self.body = None
+        self.etag = None
+
+    async def load(self):
+        if self.rows is None:
+            version = self.version
+            async with _connect() as db:
+                async with db.execute(self.query) as cursor:
+                    rows = [dict(row) for row in await cursor.fetchall()]
+            # Only keep the result if nothing was written while we were reading,
+            # and never cache what an uncommitted transaction sees
+            if version == self.version and _active_tx() is None:
+                self.body = json.dumps(rows).encode()
+                self.etag = f'"{hashlib.sha1(self.body).hexdigest()[:16]}"'
+                self.rows = rows
+            return rows
+        return self.rows
+
+_catalogs = {
+    'menu': Catalog("SELECT * FROM menu_items WHERE is_available = 1"),
+    'rooms': Catalog("SELECT * FROM rooms ORDER BY number"),
+}
+
+def get_catalog_version(name):
+    return _catalogs[name].version
+
+async def _catalog_changed(db, name):
+    # Inside the write: bump the shared counter now, drop our own copy on commit
+    await db.execute("UPDATE meta SET value = value + 1 WHERE key = ?", (f"catalog:{name}",))
+    on_commit(_catalogs[name].invalidate)
+
+async def sync_catalogs():
+    # Picks up catalog writes made by other processes
+    async with _connect() as db:
+        async with db.execute("SELECT key, value FROM meta WHERE key LIKE 'catalog:%'") as cursor:
+            rows = await cursor.fetchall()
+    for key, value in rows:
+        catalog = _catalogs.get(key.split(':', 1)[1])
+        if catalog is None or catalog.shared_version == value:
+            continue
+        if catalog.shared_version is not None:
+            catalog.invalidate()
+        catalog.shared_version = value
+
+async def _get_catalog_json(name):
+    catalog = _catalogs[name]
+    rows = await catalog.load()
+    if catalog.body is None:
+        # Invalidated mid-load: serialize this one answer without caching it
+        body = json.dumps(rows).encode()
+        return body, f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+    return catalog.body, catalog.etag
+
 # --- Menu ---
 async def add_menu_item(name, price, description, category):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         cursor = await db.execute("""
             INSERT INTO menu_items (name, price, description, category)
             VALUES (?, ?, ?, ?)
         """, (name, price, description, category))
-        await db.commit()
-        return cursor.lastrowid
+        await _catalog_changed(db, 'menu')
+    return cursor.lastrowid
 
 async def get_menu_items():
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM menu_items WHERE is_available = 1") as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+    rows = await _catalogs['menu'].load()
+    return [dict(row) for row in rows]
+
+async def get_menu_json():
+    return await _get_catalog_json('menu')
 
 async def delete_menu_item(item_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         await db.execute("DELETE FROM menu_items WHERE id = ?", (item_id,))
-        await db.commit()
+        await _catalog_changed(db, 'menu')
 
 # --- Rooms ---
 async def add_room(number, type, price, description):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         try:
             cursor = await db.execute("""
                 INSERT INTO rooms (number, type, price, description)
                 VALUES (?, ?, ?, ?)
             """, (number, type, price, description))
-            await db.commit()
-            return cursor.lastrowid
         except aiosqlite.IntegrityError:
             return None # Room already exists
+        await _catalog_changed(db, 'rooms')
+    return cursor.lastrowid
 
 async def get_rooms():
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM rooms ORDER BY number") as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+    rows = await _catalogs['rooms'].load()
+    return [dict(row) for row in rows]
+
+async def get_rooms_json():
+    return await _get_catalog_json('rooms')
 
 async def delete_room(room_id):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         await db.execute("DELETE FROM rooms WHERE id = ?", (room_id,))
-        await db.commit()
+        await _catalog_changed(db, 'rooms')
+
+# --- FSM storage ---
+async def get_fsm_record(key):
+    async with _connect() as db:
+        async with db.execute("SELECT state, data FROM fsm_states WHERE key = ?", (key,)) as cursor:
+            row = await cursor.fetchone()
+    if row is None:
+        return None, {}
+    return row['state'], json.loads(row['data'] or '{}')
+
+async def _prune_fsm_record(db, key):
+    # A cleared state with no data is the same as no row
+    await db.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+async def set_fsm_state(key, state):
+    async with _transaction() as db:
+        await db.execute("""
+            INSERT INTO fsm_states (key, state) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state
+        """, (key, state))
+        await _prune_fsm_record(db, key)
+
+async def set_fsm_data(key, data):
+    async with _transaction() as db:
+        await db.execute("""
+            INSERT INTO fsm_states (key, data) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET data = excluded.data
+        """, (key, json.dumps(data)))
+        await _prune_fsm_record(db, key)
 
 # --- Reviews ---
 async def add_review(user_id, rating, text):
     created_at = datetime.now().isoformat()
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _transaction() as db:
         await db.execute("""
             INSERT INTO reviews (user_id, rating, text, created_at)
             VALUES (?, ?, ?, ?)
         """, (user_id, rating, text, created_at))
-        await db.commit()
+
+# --- Outbox ---
+async def enqueue_notification(chat_id, text, digest=None, send_at=0):
+    # digest: JSON-able summary of the event; such rows wait until send_at and
+    # are merged with the chat's other pending digest rows into one message
+    created_at = datetime.now().isoformat()
+    async with _transaction() as db:
+        cursor = await db.execute("""
+            INSERT INTO outbox (chat_id, text, created_at, digest, next_attempt_at) VALUES (?, ?, ?, ?, ?)
+        """, (chat_id, text, created_at, json.dumps(digest) if digest is not None else None, send_at))
+    return cursor.lastrowid
+
+async def fetch_due_notifications(now, limit=50):
+    async with _connect() as db:
+        # A chat whose earlier message is waiting for a retry is held back, keeping per-chat order.
+        # Digest rows still inside their window (attempts = 0) do not hold anything back.
+        async with db.execute("""
+            SELECT * FROM outbox o
+            WHERE o.status = 'pending' AND o.next_attempt_at <= ?
+              AND NOT EXISTS (
+                  SELECT 1 FROM outbox p
+                  WHERE p.chat_id = o.chat_id AND p.status = 'pending' AND p.id < o.id
+                    AND p.next_attempt_at > ? AND p.attempts > 0
+              )
+            ORDER BY o.id LIMIT ?
+        """, (now, now, limit)) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+async def get_pending_digest(chat_id, limit=200):
+    # Everything queued for the chat's digest so far, due or not: the window runs from the first event
+    async with _connect() as db:
+        async with db.execute("""
+            SELECT * FROM outbox
+            WHERE chat_id = ? AND status = 'pending' AND digest IS NOT NULL
+            ORDER BY id LIMIT ?
+        """, (chat_id, limit)) as cursor:
+            rows = [dict(row) for row in await cursor.fetchall()]
+    for row in rows:
+        row['digest'] = json.loads(row['digest'])
+    return rows
+
+async def mark_notifications_sent(notification_ids):
+    async with _transaction() as db:
+        await db.executemany("""
+            UPDATE outbox SET status = 'sent', attempts = attempts + 1, last_error = NULL WHERE id = ?
+        """, [(notification_id,) for notification_id in notification_ids])
+
+async def get_activity_totals(since, until):
+    async with _connect() as db:
+        async with db.execute("""
+            SELECT COUNT(*), COALESCE(SUM(total_price), 0) FROM orders WHERE created_at >= ? AND created_at < ?
+        """, (since, until)) as cursor:
+            orders_count, orders_total = await cursor.fetchone()
+        async with db.execute("""
+            SELECT COUNT(*), AVG(rating) FROM reviews WHERE created_at >= ? AND created_at < ?
+        """, (since, until)) as cursor:
+            reviews_count, avg_rating = await cursor.fetchone()
+    return {
+        "orders": orders_count,
+        "orders_total": orders_total,
+        "reviews": reviews_count,
+        "avg_rating": avg_rating
+    }
+
+async def claim_summary_period(key, until, interval):
+    # Moves the meta marker forward with compare-and-set so only one caller reports each period.
+    # Returns the start of the claimed period, or None if it is not due yet or another caller won.
+    due_before = (datetime.fromisoformat(until) - timedelta(seconds=interval)).isoformat()
+    async with _transaction() as db:
+        async with db.execute("SELECT value FROM meta WHERE key = ?", (key,)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            # First run: start counting from now rather than reporting all history
+            await db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (key, until))
+            return None
+        since = row[0]
+        if since > due_before:
+            return None
+        cursor = await db.execute("UPDATE meta SET value = ? WHERE key = ? AND value = ?", (until, key, since))
+        return since if cursor.rowcount else None
+
+async def next_notification_due():
+    async with _connect() as db:
+        async with db.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'") as cursor:
+            row = await cursor.fetchone()
+            return row[0]
+
+async def reschedule_notification(notification_id, next_attempt_at, error, give_up=False):
+    async with _transaction() as db:
+        await db.execute("""
+            UPDATE outbox SET status = ?, attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?
+        """, ('failed' if give_up else 'pending', next_attempt_at, error, notification_id))
+
+async def prune_outbox(older_than):
+    # Delivered messages are only kept for a while for debugging
+    async with _transaction() as db:
+        await db.execute("DELETE FROM outbox WHERE status = 'sent' AND created_at < ?", (older_than,))
+
+# Chunk functions of the backfills that migrations may schedule
+async def _backfill_indexes(db, position, chunk_size):
+    # One CREATE INDEX per transaction; the cursor is the position in INDEXES
+    if position >= len(INDEXES):
+        return None
+    await db.execute(INDEXES[position])
+    return position + 1
+
+BACKFILLS = {
+    'indexes': _backfill_indexes,
+    'order_items': _backfill_order_items,
+}
+
+async def _main(args):
+    await init_db()
+    # python database.py rebuild-stats | rebuild-search
+    if args[:1] == ['rebuild-stats']:
+        print(await rebuild_daily_stats())
+    elif args[:1] == ['rebuild-search']:
+        await rebuild_guest_search()
 
 if __name__ == "__main__":
-    asyncio.run(init_db())
+    asyncio.run(_main(sys.argv[1:]))
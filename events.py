@@ -0,0 +1,102 @@
+import asyncio
+import json
+import logging
+
+from aiohttp import web, WSMsgType
+
+import database as db
+
+# Messages a client may lag behind before we drop it; it reconnects with ?since=<rev>
+SUBSCRIBER_QUEUE_SIZE = 64
+
+class Subscriber:
+    def __init__(self, ws):
+        self.ws = ws
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+class EventHub:
+    def __init__(self):
+        self.subscribers = set()
+        self.rev = 0
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    async def subscribe(self, subscriber):
+        if not self.subscribers:
+            # Nobody was listening, so nothing was broadcast meanwhile: start from now
+            self.rev = await db.get_revision()
+        self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def close(self):
+        for subscriber in list(self.subscribers):
+            await subscriber.ws.close(code=1001, message=b"server shutdown")
+        self.subscribers.clear()
+
+    def broadcast(self, message):
+        # Serialize once, fan the same string out to every subscriber
+        data = json.dumps(message)
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                logging.warning("Dropping slow event subscriber")
+                self.unsubscribe(subscriber)
+                self._spawn(subscriber.ws.close(code=4000, message=b"slow consumer"))
+
+    async def publish(self, event):
+        if not self.subscribers:
+            return
+        async with self._lock:
+            changes = await db.get_booking_changes(self.rev)
+            self.rev = changes['rev']
+            if changes.get('resync'):
+                # Too many rows to list (a bulk import): clients reload what they show
+                event = 'resync'
+            self.broadcast({"event": event, **changes})
+
+    def notify(self, event):
+        # Fire-and-forget so HTTP and bot handlers never wait on subscribers
+        self._spawn(self.publish(event))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+async def _pump(subscriber):
+    try:
+        while True:
+            data = await subscriber.queue.get()
+            await subscriber.ws.send_str(data)
+    except ConnectionResetError:
+        pass
+
+async def handle_events(request):
+    hub = request.app['hub']
+    try:
+        since = int(request.query['since']) if 'since' in request.query else None
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid since"}, status=400)
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    subscriber = Subscriber(ws)
+    # Subscribe before reading the backlog so nothing falls between the two
+    await hub.subscribe(subscriber)
+    pump = asyncio.create_task(_pump(subscriber))
+    try:
+        if since is not None:
+            changes = await db.get_booking_changes(since)
+            subscriber.queue.put_nowait(json.dumps({"event": "resync", **changes}))
+
+        async for msg in ws:
+            if msg.type == WSMsgType.ERROR:
+                break
+    finally:
+        hub.unsubscribe(subscriber)
+        pump.cancel()
+    return ws
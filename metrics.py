@@ -0,0 +1,169 @@
+import asyncio
+import bisect
+import inspect
+import time
+from functools import wraps
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+# Seconds; covers sub-millisecond SQLite reads up to slow Telegram calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+# Plain dicts keyed by the label values tuple: one lookup and an add per observation.
+# Everything runs on the event loop thread, so no locking is needed.
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, label_values=(), amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self.series = {}
+        REGISTRY.append(self)
+
+    def observe(self, label_values, value):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = _labels(self.labels, label_values, f'le="{bound}"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            cumulative += counts[-1]
+            bucket_labels = _labels(self.labels, label_values, 'le="+Inf"')
+            yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}"
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# --- HTTP ---
+http_requests = Counter('http_requests_total', 'HTTP requests by route and status', ('method', 'route', 'status'))
+http_duration = Histogram('http_request_duration_seconds', 'HTTP request latency', ('method', 'route'))
+
+@web.middleware
+async def http_middleware(request, handler):
+    resource = request.match_info.route.resource
+    # The route pattern, not the path, so /api/bookings/{id} stays one series
+    route = resource.canonical if resource is not None else 'unmatched'
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    except asyncio.CancelledError:
+        # Client went away
+        status = 499
+        raise
+    finally:
+        http_requests.inc((request.method, route, status))
+        http_duration.observe((request.method, route), time.perf_counter() - start)
+
+async def handle_metrics(request):
+    return web.Response(text=render_metrics(), content_type='text/plain', headers={'Cache-Control': 'no-store'})
+
+# --- Database ---
+db_duration = Histogram('db_call_duration_seconds', 'Latency of database.py functions', ('function',))
+db_rows = Counter('db_rows_returned_total', 'Rows returned by database.py functions', ('function',))
+db_errors = Counter('db_call_errors_total', 'database.py calls that raised', ('function',))
+
+def _row_count(result):
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict):
+        return 1
+    return 0
+
+def _timed(name, func):
+    labels = (name,)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException:
+            db_errors.inc(labels)
+            raise
+        finally:
+            db_duration.observe(labels, time.perf_counter() - start)
+        rows = _row_count(result)
+        if rows:
+            db_rows.inc(labels, rows)
+        return result
+
+    wrapper.instrumented = True
+    return wrapper
+
+def instrument_module(module):
+    # Swaps every public coroutine function of the module for a timed wrapper.
+    # Callers go through module attributes (db.get_booking), so they all get it.
+    for name, func in list(vars(module).items()):
+        if name.startswith('_') or not inspect.iscoroutinefunction(func):
+            continue
+        if func.__module__ != module.__name__ or getattr(func, 'instrumented', False):
+            continue
+        setattr(module, name, _timed(name, func))
+
+# --- Bot ---
+bot_duration = Histogram('bot_handler_duration_seconds', 'Latency of bot handlers', ('handler',))
+bot_errors = Counter('bot_handler_errors_total', 'Bot handlers that raised', ('handler',))
+
+class HandlerTimer(BaseMiddleware):
+    # Inner middleware: runs only for the handler that matched, which aiogram passes in data['handler']
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        labels = (handler_object.callback.__name__ if handler_object else 'unknown',)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except BaseException:
+            bot_errors.inc(labels)
+            raise
+        finally:
+            bot_duration.observe(labels, time.perf_counter() - start)
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramUnauthorizedError,
+)
+
+import database as db
+
+# Telegram allows ~30 messages/s per bot and ~1 message/s per chat
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+MAX_ATTEMPTS = 8
+MAX_BACKOFF = 300
+POLL_INTERVAL = 2
+FETCH_LIMIT = 50
+KEEP_SENT_DAYS = 7
+# Telegram caps a message at 4096 characters; leave room for the header
+DIGEST_MAX_LENGTH = 3800
+SUMMARY_KEY = 'admin_summary_at'
+SUMMARY_POLL_INTERVAL = 60
+
+# Errors that will not go away by retrying
+PERMANENT_ERRORS = (TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramUnauthorizedError)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # Used for retry_after: no tokens until the pause is over
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+def format_digest(rows):
+    # Merges digest rows into one message grouped by their "group" (room); returns (text, ids).
+    # Rows that do not fit stay pending for the next message.
+    groups = {}
+    ids = []
+    amount = 0
+    length = 0
+    for row in rows:
+        digest = row['digest']
+        line = f"• {digest['line']}"
+        length += len(line) + 1
+        if ids and length > DIGEST_MAX_LENGTH:
+            break
+        ids.append(row['id'])
+        groups.setdefault(digest['group'], []).append(line)
+        amount += digest.get('amount') or 0
+
+    parts = [f"🔔 <b>Сводка</b> (новых событий: {len(ids)})"]
+    if amount:
+        parts[0] += f"\nСумма заказов: {amount:g} ₽"
+    for group, lines in groups.items():
+        parts.append(f"<b>{group}</b>\n" + "\n".join(lines))
+    return "\n\n".join(parts), ids
+
+def format_summary(since, totals):
+    text = (
+        f"📊 <b>Итоги с {since[:16].replace('T', ' ')}</b>\n"
+        f"Заказов: {totals['orders']} на {totals['orders_total']:g} ₽\n"
+        f"Отзывов: {totals['reviews']}"
+    )
+    if totals['avg_rating'] is not None:
+        text += f" (средняя оценка {totals['avg_rating']:.1f})"
+    return text
+
+class OutboxDispatcher:
+    def __init__(self):
+        self.bot = None
+        self._wake = asyncio.Event()
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._workers = {}
+        self._task = None
+        self._summary_task = None
+        self._last_prune = 0
+
+    def wake(self):
+        self._wake.set()
+
+    async def start(self, bot, summary_chat_id=None, summary_interval=0):
+        self.bot = bot
+        self._task = asyncio.create_task(self._run())
+        if summary_chat_id is not None and summary_interval > 0:
+            self._summary_task = asyncio.create_task(self._summary_loop(summary_chat_id, summary_interval))
+
+    async def stop(self):
+        # Anything not sent yet stays pending and goes out after the next start
+        tasks = [task for task in [self._task, self._summary_task, *self._workers.values()] if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._summary_task = None
+        self._workers.clear()
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                timeout = await self._dispatch_due()
+                await self._prune()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Outbox dispatcher error: {e}")
+                timeout = POLL_INTERVAL
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch_due(self):
+        now = time.time()
+        rows = await db.fetch_due_notifications(now, FETCH_LIMIT)
+        by_chat = {}
+        for row in rows:
+            # A chat is served by one worker at a time, which keeps its messages in order
+            if row['chat_id'] not in self._workers:
+                by_chat.setdefault(row['chat_id'], []).append(row)
+        for chat_id, chat_rows in by_chat.items():
+            self._workers[chat_id] = asyncio.create_task(self._send_chat(chat_id, chat_rows))
+
+        next_due = await db.next_notification_due()
+        if next_due is not None and next_due > now:
+            return min(POLL_INTERVAL, next_due - now)
+        return POLL_INTERVAL
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets.clear()
+            bucket = self._chat_buckets[chat_id] = TokenBucket(PER_CHAT_RATE, 1)
+        return bucket
+
+    async def _send_chat(self, chat_id, rows):
+        try:
+            bucket = self._chat_bucket(chat_id)
+            merged = set()
+            for row in rows:
+                if row['id'] in merged:
+                    continue
+                await bucket.acquire()
+                await self._global.acquire()
+                if row['digest'] is not None:
+                    sent, ids = await self._send_digest(row, bucket)
+                    merged.update(ids)
+                else:
+                    sent = await self._send(row, bucket)
+                if not sent:
+                    # Rate limited or failing: leave the rest for a later round
+                    break
+        except Exception as e:
+            logging.error(f"Outbox worker for chat {chat_id} failed: {e}")
+        finally:
+            self._workers.pop(chat_id, None)
+            self.wake()
+
+    async def _send_digest(self, row, bucket):
+        rows = await db.get_pending_digest(row['chat_id'])
+        if not rows or rows[0]['id'] != row['id']:
+            rows = [{**row, 'digest': json.loads(row['digest'])}]
+        text, ids = format_digest(rows)
+        if len(ids) == 1:
+            # Nothing to merge with: send the full single-event message
+            return await self._send(row, bucket, rows[0]['text']), ids
+        try:
+            return await self._send(row, bucket, text, ids), ids
+        except PERMANENT_ERRORS as e:
+            # One bad event must not drop the rest of the digest: send them one by one
+            logging.warning(f"Digest {row['id']} to {row['chat_id']} rejected, sending events separately: {e}")
+        done = []
+        for item in rows[:len(ids)]:
+            await bucket.acquire()
+            await self._global.acquire()
+            if not await self._send(item, bucket):
+                return False, done
+            done.append(item['id'])
+        return True, done
+
+    async def _send(self, row, bucket, text=None, ids=None):
+        # ids: every outbox row the message covers; retries are tracked on the first one
+        ids = ids or [row['id']]
+        try:
+            await self.bot.send_message(row['chat_id'], text or row['text'])
+        except TelegramRetryAfter as e:
+            bucket.pause(e.retry_after)
+            await db.reschedule_notification(row['id'], time.time() + e.retry_after, str(e))
+            return False
+        except PERMANENT_ERRORS as e:
+            if len(ids) > 1:
+                # A merged digest: the caller retries its events one at a time
+                raise
+            logging.error(f"Dropping notification {row['id']} to {row['chat_id']}: {e}")
+            await db.reschedule_notification(row['id'], 0, str(e), give_up=True)
+            return True
+        except Exception as e:
+            attempts = row['attempts'] + 1
+            give_up = attempts >= MAX_ATTEMPTS
+            delay = min(2 ** attempts, MAX_BACKOFF) * random.uniform(0.5, 1.5)
+            logging.warning(f"Notification {row['id']} failed (attempt {attempts}): {e}")
+            await db.reschedule_notification(row['id'], time.time() + delay, str(e), give_up=give_up)
+            return False
+        await db.mark_notifications_sent(ids)
+        return True
+
+    async def _summary_loop(self, chat_id, interval):
+        while True:
+            try:
+                now = datetime.now()
+                since = await db.claim_summary_period(SUMMARY_KEY, now.isoformat(), interval)
+                if since is not None:
+                    totals = await db.get_activity_totals(since, now.isoformat())
+                    # Quiet periods are not worth a message
+                    if totals['orders'] or totals['reviews']:
+                        await db.enqueue_notification(chat_id, format_summary(since, totals))
+                        self.wake()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Outbox summary error: {e}")
+            await asyncio.sleep(min(interval, SUMMARY_POLL_INTERVAL))
+
+    async def _prune(self):
+        if time.monotonic() - self._last_prune < 3600:
+            return
+        self._last_prune = time.monotonic()
+        await db.prune_outbox((datetime.now() - timedelta(days=KEEP_SENT_DAYS)).isoformat())
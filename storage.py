@@ -0,0 +1,33 @@
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+import database as db
+
+class SQLiteStorage(BaseStorage):
+    # aiogram FSM storage in the bot's own database: half-finished flows (phone
+    # registration) survive restarts and every worker process sees the same state
+    @staticmethod
+    def _key(key):
+        return ':'.join(str(part) if part is not None else '' for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    async def set_state(self, key, state=None):
+        await db.set_fsm_state(self._key(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        state, _ = await db.get_fsm_record(self._key(key))
+        return state
+
+    async def set_data(self, key, data):
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        await db.set_fsm_data(self._key(key), data)
+
+    async def get_data(self, key):
+        _, data = await db.get_fsm_record(self._key(key))
+        return data
+
+    async def close(self):
+        pass
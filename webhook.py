@@ -0,0 +1,72 @@
+import asyncio
+import hmac
+import logging
+
+from aiogram.types import Update
+from aiohttp import web
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+class WebhookReceiver:
+    # Telegram POSTs updates here. We answer 200 as soon as the update is parsed and
+    # queued, since a slow or failed answer makes Telegram resend the same update (a
+    # duplicate order). Processing runs in the background, at most max_concurrency at
+    # a time; when all slots are busy the request waits, which throttles Telegram too.
+    def __init__(self, dispatcher, secret, max_concurrency=32):
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self.max_concurrency = max_concurrency
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+        self.active = False
+
+    async def handle(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            return web.Response(status=401)
+        bot = request.app['bot']
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except ValueError as e:
+            logging.warning(f"Rejected webhook payload: {e}")
+            return web.Response(status=400)
+
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, bot, update):
+        try:
+            await self.dispatcher.feed_update(bot, update)
+        except Exception as e:
+            logging.error(f"Update {update.update_id} failed: {e}")
+        finally:
+            self._slots.release()
+
+    async def start(self, bot, url):
+        # Returns False if Telegram refused, so the caller can fall back to polling
+        try:
+            await bot.set_webhook(
+                url,
+                secret_token=self.secret,
+                max_connections=self.max_concurrency,
+                allowed_updates=self.dispatcher.resolve_used_update_types()
+            )
+        except Exception as e:
+            logging.error(f"Could not set webhook {url}: {e}")
+            return False
+        self.active = True
+        logging.info(f"Receiving updates via webhook {url}")
+        return True
+
+    async def stop(self, bot):
+        if self.active:
+            self.active = False
+            try:
+                await bot.delete_webhook()
+            except Exception as e:
+                logging.error(f"Could not delete webhook: {e}")
+        # Let updates that were already acknowledged finish before the DB closes
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+from multiprocessing.connection import wait
+
+import database as db
+
+# How often a worker looks for writes made by its siblings
+SYNC_INTERVAL = 0.5
+RESTART_DELAY = 1
+# Seconds the workers get to finish after a stop signal before they are killed
+SHUTDOWN_GRACE = 10
+
+def graceful_shutdown():
+    # SIGTERM (systemd, docker stop) and Ctrl+C both shut down once, running the cleanup handlers.
+    # Later signals are ignored: a worker can get SIGINT from the terminal, SIGTERM from
+    # the parent and from systemd, and a second KeyboardInterrupt would cut the cleanup short.
+    # (A Python no-op rather than SIG_IGN, which fails on a signal that is already pending)
+    def ignore(signum, frame):
+        pass
+
+    def stop(signum, frame):
+        signal.signal(signal.SIGINT, ignore)
+        signal.signal(signal.SIGTERM, ignore)
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+def run_workers(count, target):
+    # Runs target(index) in `count` processes and restarts any that crash.
+    # On a stop signal every worker gets SIGTERM; any still running after SHUTDOWN_GRACE are killed.
+    graceful_shutdown()
+    processes = {}
+
+    def spawn(index):
+        process = multiprocessing.Process(target=target, args=(index,), name=f"worker-{index}")
+        process.start()
+        processes[index] = process
+
+    for index in range(count):
+        spawn(index)
+    try:
+        while processes:
+            wait([process.sentinel for process in processes.values()])
+            for index, process in list(processes.items()):
+                if process.exitcode is None:
+                    continue
+                del processes[index]
+                if process.exitcode != 0:
+                    logging.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    time.sleep(RESTART_DELAY)
+                    spawn(index)
+    except KeyboardInterrupt:
+        # docker stop signals only this process, so pass it on before waiting
+        for process in processes.values():
+            if process.exitcode is None:
+                process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_GRACE
+        for process in processes.values():
+            process.join(max(0, deadline - time.monotonic()))
+        for index, process in processes.items():
+            if process.exitcode is None:
+                logging.error(f"Worker {index} did not stop in {SHUTDOWN_GRACE}s, killing it")
+                process.kill()
+                process.join()
+
+async def follow_other_workers(hub):
+    # Caches and the event hub only hear about this process's own commits.
+    # Poll the shared counters so writes from other workers reach them too.
+    while True:
+        try:
+            await db.sync_catalogs()
+            await db.sync_lookups()
+            if hub.subscribers and await db.get_revision() != hub.rev:
+                await hub.publish('sync')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Worker sync failed: {e}")
+        await asyncio.sleep(SYNC_INTERVAL)